@@ -0,0 +1,436 @@
+/* Compiled ticket kernel for consistent_sampler.py.
+ *
+ * Provides drop-in replacements for the pure-Python routines
+ * sha256_uniform, next_fraction, and first_fractions.  Outputs are
+ * identical to the Python versions; consistent_sampler.py selects
+ * this module automatically at import time when it has been built,
+ * and otherwise falls back to the Python code.
+ *
+ * The SHA256 code follows FIPS 180-4 directly.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+
+/* ---------------------------------------------------------------- */
+/* SHA256                                                           */
+/* ---------------------------------------------------------------- */
+
+typedef struct {
+    uint32_t state[8];
+    uint64_t length;            /* total bytes hashed so far */
+    unsigned char buffer[64];
+    size_t fill;                /* bytes currently in buffer */
+} sha256_ctx;
+
+static const uint32_t K256[64] = {
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1,
+    0x923f82a4, 0xab1c5ed5, 0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3,
+    0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174, 0xe49b69c1, 0xefbe4786,
+    0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147,
+    0x06ca6351, 0x14292967, 0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13,
+    0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85, 0xa2bfe8a1, 0xa81a664b,
+    0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a,
+    0x5b9cca4f, 0x682e6ff3, 0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208,
+    0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+};
+
+#define ROTR(x, n) (((x) >> (n)) | ((x) << (32 - (n))))
+
+static void
+sha256_init(sha256_ctx *ctx)
+{
+    ctx->state[0] = 0x6a09e667;
+    ctx->state[1] = 0xbb67ae85;
+    ctx->state[2] = 0x3c6ef372;
+    ctx->state[3] = 0xa54ff53a;
+    ctx->state[4] = 0x510e527f;
+    ctx->state[5] = 0x9b05688c;
+    ctx->state[6] = 0x1f83d9ab;
+    ctx->state[7] = 0x5be0cd19;
+    ctx->length = 0;
+    ctx->fill = 0;
+}
+
+static void
+sha256_block(sha256_ctx *ctx, const unsigned char *p)
+{
+    uint32_t w[64];
+    uint32_t a, b, c, d, e, f, g, h, t1, t2;
+    int i;
+
+    for (i = 0; i < 16; i++) {
+        w[i] = ((uint32_t)p[4 * i] << 24) | ((uint32_t)p[4 * i + 1] << 16) |
+               ((uint32_t)p[4 * i + 2] << 8) | (uint32_t)p[4 * i + 3];
+    }
+    for (i = 16; i < 64; i++) {
+        uint32_t s0 = ROTR(w[i - 15], 7) ^ ROTR(w[i - 15], 18) ^ (w[i - 15] >> 3);
+        uint32_t s1 = ROTR(w[i - 2], 17) ^ ROTR(w[i - 2], 19) ^ (w[i - 2] >> 10);
+        w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+    }
+
+    a = ctx->state[0]; b = ctx->state[1]; c = ctx->state[2]; d = ctx->state[3];
+    e = ctx->state[4]; f = ctx->state[5]; g = ctx->state[6]; h = ctx->state[7];
+
+    for (i = 0; i < 64; i++) {
+        t1 = h + (ROTR(e, 6) ^ ROTR(e, 11) ^ ROTR(e, 25)) +
+             ((e & f) ^ (~e & g)) + K256[i] + w[i];
+        t2 = (ROTR(a, 2) ^ ROTR(a, 13) ^ ROTR(a, 22)) +
+             ((a & b) ^ (a & c) ^ (b & c));
+        h = g; g = f; f = e; e = d + t1;
+        d = c; c = b; b = a; a = t1 + t2;
+    }
+
+    ctx->state[0] += a; ctx->state[1] += b; ctx->state[2] += c; ctx->state[3] += d;
+    ctx->state[4] += e; ctx->state[5] += f; ctx->state[6] += g; ctx->state[7] += h;
+}
+
+static void
+sha256_update(sha256_ctx *ctx, const unsigned char *data, size_t len)
+{
+    ctx->length += len;
+    if (ctx->fill > 0) {
+        size_t take = 64 - ctx->fill;
+        if (take > len)
+            take = len;
+        memcpy(ctx->buffer + ctx->fill, data, take);
+        ctx->fill += take;
+        data += take;
+        len -= take;
+        if (ctx->fill < 64)
+            return;
+        sha256_block(ctx, ctx->buffer);
+        ctx->fill = 0;
+    }
+    while (len >= 64) {
+        sha256_block(ctx, data);
+        data += 64;
+        len -= 64;
+    }
+    if (len > 0) {
+        memcpy(ctx->buffer, data, len);
+        ctx->fill = len;
+    }
+}
+
+static void
+sha256_final(sha256_ctx *ctx, unsigned char digest[32])
+{
+    uint64_t bits = ctx->length * 8;
+    unsigned char pad[72];
+    size_t padlen = (ctx->fill < 56) ? 56 - ctx->fill : 120 - ctx->fill;
+    int i;
+
+    memset(pad, 0, sizeof(pad));
+    pad[0] = 0x80;
+    for (i = 0; i < 8; i++)
+        pad[padlen + i] = (unsigned char)(bits >> (56 - 8 * i));
+    sha256_update(ctx, pad, padlen + 8);
+    for (i = 0; i < 8; i++) {
+        digest[4 * i] = (unsigned char)(ctx->state[i] >> 24);
+        digest[4 * i + 1] = (unsigned char)(ctx->state[i] >> 16);
+        digest[4 * i + 2] = (unsigned char)(ctx->state[i] >> 8);
+        digest[4 * i + 3] = (unsigned char)(ctx->state[i]);
+    }
+}
+
+/* ---------------------------------------------------------------- */
+/* Digest to reversed decimal digits                                */
+/* ---------------------------------------------------------------- */
+
+/* A 256-bit value has at most 78 decimal digits; we produce 81 (nine
+   groups of nine) and report how many are significant, padded to 64
+   as "{:064d}" does in sha256_uniform. */
+#define MAX_DIGITS 81
+
+static Py_ssize_t
+reversed_decimal(const unsigned char digest[32], char *out)
+{
+    uint32_t limbs[8];
+    Py_ssize_t n, ndigits = 0;
+    int i, group, j;
+
+    for (i = 0; i < 8; i++) {
+        limbs[i] = ((uint32_t)digest[4 * i] << 24) |
+                   ((uint32_t)digest[4 * i + 1] << 16) |
+                   ((uint32_t)digest[4 * i + 2] << 8) |
+                   (uint32_t)digest[4 * i + 3];
+    }
+    /* Repeated division by 10**9 yields the digits low-order first,
+       which is exactly the reversed order that sha256_uniform wants. */
+    n = 0;
+    for (group = 0; group < 9; group++) {
+        uint64_t rem = 0;
+        for (i = 0; i < 8; i++) {
+            uint64_t cur = (rem << 32) | limbs[i];
+            limbs[i] = (uint32_t)(cur / 1000000000u);
+            rem = cur % 1000000000u;
+        }
+        for (j = 0; j < 9; j++) {
+            out[n++] = (char)('0' + rem % 10);
+            rem /= 10;
+        }
+    }
+    for (n = MAX_DIGITS; n > 0; n--) {
+        if (out[n - 1] != '0') {
+            ndigits = n;
+            break;
+        }
+    }
+    return ndigits < 64 ? 64 : ndigits;
+}
+
+/* Write "0." followed by the reversed digits of SHA256(data) into out,
+   which must have room for 2 + MAX_DIGITS bytes.  Returns length. */
+static Py_ssize_t
+uniform_of_ctx(sha256_ctx *ctx, char *out)
+{
+    unsigned char digest[32];
+
+    sha256_final(ctx, digest);
+    out[0] = '0';
+    out[1] = '.';
+    return 2 + reversed_decimal(digest, out + 2);
+}
+
+static Py_ssize_t
+uniform_of_bytes(const char *data, Py_ssize_t len, char *out)
+{
+    sha256_ctx ctx;
+
+    sha256_init(&ctx);
+    sha256_update(&ctx, (const unsigned char *)data, (size_t)len);
+    return uniform_of_ctx(&ctx, out);
+}
+
+/* UTF-8 encoding of str(obj).  On success *str_obj holds a new
+   reference that keeps the returned buffer alive. */
+static const char *
+str_utf8(PyObject *obj, PyObject **str_obj, Py_ssize_t *len)
+{
+    const char *data;
+
+    *str_obj = PyObject_Str(obj);
+    if (*str_obj == NULL)
+        return NULL;
+    data = PyUnicode_AsUTF8AndSize(*str_obj, len);
+    if (data == NULL)
+        Py_CLEAR(*str_obj);
+    return data;
+}
+
+/* ---------------------------------------------------------------- */
+/* Python-visible functions                                         */
+/* ---------------------------------------------------------------- */
+
+PyDoc_STRVAR(sha256_uniform_doc,
+"sha256_uniform(hash_input)\n\n"
+"Return SHA256 hash of str(hash_input) as string representation of\n"
+"a real in (0, 1).  Compiled equivalent of\n"
+"consistent_sampler.sha256_uniform.");
+
+static PyObject *
+kernel_sha256_uniform(PyObject *self, PyObject *hash_input)
+{
+    PyObject *s;
+    const char *data;
+    Py_ssize_t len, outlen;
+    char out[2 + MAX_DIGITS];
+
+    data = str_utf8(hash_input, &s, &len);
+    if (data == NULL)
+        return NULL;
+    outlen = uniform_of_bytes(data, len, out);
+    Py_DECREF(s);
+    return PyUnicode_FromStringAndSize(out, outlen);
+}
+
+/* Compare byte strings the way Python compares (ASCII) str objects. */
+static int
+bytes_cmp(const char *a, Py_ssize_t alen, const char *b, Py_ssize_t blen)
+{
+    int c = memcmp(a, b, (size_t)(alen < blen ? alen : blen));
+
+    if (c != 0)
+        return c;
+    return (alen > blen) - (alen < blen);
+}
+
+PyDoc_STRVAR(next_fraction_doc,
+"next_fraction(x)\n\n"
+"Return pseudorandom real y in (x, 1) (so y>x).  Compiled equivalent\n"
+"of consistent_sampler.next_fraction.");
+
+static PyObject *
+kernel_next_fraction(PyObject *self, PyObject *x)
+{
+    const char *xs;
+    char *x0 = NULL, *hin = NULL, *y = NULL;
+    Py_ssize_t xlen, p, ylen = 0, hlen;
+    unsigned long i;
+    char u[2 + MAX_DIGITS];
+    PyObject *result = NULL;
+
+    if (!PyUnicode_Check(x)) {
+        PyErr_SetString(PyExc_TypeError, "next_fraction expects a str");
+        return NULL;
+    }
+    xs = PyUnicode_AsUTF8AndSize(x, &xlen);
+    if (xs == NULL)
+        return NULL;
+    if (xlen < 2 || xs[0] != '0' || xs[1] != '.') {
+        PyErr_SetNone(PyExc_AssertionError);
+        return NULL;
+    }
+
+    /* x0 = x + '0', in case x mantissa is all 9s */
+    x0 = PyMem_Malloc((size_t)xlen + 1);
+    hin = PyMem_Malloc((size_t)xlen + 32);
+    y = PyMem_Malloc((size_t)xlen + 1 + 2 + MAX_DIGITS);
+    if (x0 == NULL || hin == NULL || y == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    memcpy(x0, xs, (size_t)xlen);
+    x0[xlen] = '0';
+    for (p = 2; p < xlen + 1; p++) {
+        if (x0[p] < '9')
+            break;
+    }
+
+    memcpy(hin, xs, (size_t)xlen);
+    hin[xlen] = ':';
+    memcpy(y, x0, (size_t)p);
+    i = 0;
+    do {
+        Py_ssize_t ulen;
+
+        i++;
+        hlen = xlen + 1 + sprintf(hin + xlen + 1, "%lu", i);
+        ulen = uniform_of_bytes(hin, hlen, u);
+        memcpy(y + p, u + 2, (size_t)(ulen - 2));
+        ylen = p + ulen - 2;
+    } while (bytes_cmp(y, ylen, x0, xlen + 1) <= 0);
+
+    result = PyUnicode_DecodeUTF8(y, ylen, NULL);
+
+done:
+    PyMem_Free(x0);
+    PyMem_Free(hin);
+    PyMem_Free(y);
+    return result;
+}
+
+PyDoc_STRVAR(first_fractions_doc,
+"first_fractions(id_list, seed, seed_hash=None)\n\n"
+"Return list of first_fraction(id, seed, seed_hash) for each id in\n"
+"id_list.  Compiled equivalent of consistent_sampler.first_fractions.");
+
+static PyObject *
+kernel_first_fractions(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = {"id_list", "seed", "seed_hash", NULL};
+    PyObject *id_list, *seed, *seed_hash = Py_None;
+    PyObject *it = NULL, *item, *result = NULL, *s;
+    const char *prefix, *data;
+    Py_ssize_t prefix_len, len, outlen;
+    char hex[65];
+    char out[2 + MAX_DIGITS];
+    sha256_ctx base, ctx;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|O:first_fractions",
+                                     kwlist, &id_list, &seed, &seed_hash))
+        return NULL;
+
+    if (seed_hash == Py_None) {
+        unsigned char digest[32];
+        int i;
+
+        data = str_utf8(seed, &s, &len);
+        if (data == NULL)
+            return NULL;
+        sha256_init(&ctx);
+        sha256_update(&ctx, (const unsigned char *)data, (size_t)len);
+        sha256_final(&ctx, digest);
+        Py_DECREF(s);
+        for (i = 0; i < 32; i++)
+            sprintf(hex + 2 * i, "%02x", digest[i]);
+        prefix = hex;
+        prefix_len = 64;
+    }
+    else {
+        if (!PyUnicode_Check(seed_hash)) {
+            PyErr_SetString(PyExc_TypeError, "seed_hash must be a str");
+            return NULL;
+        }
+        prefix = PyUnicode_AsUTF8AndSize(seed_hash, &prefix_len);
+        if (prefix == NULL)
+            return NULL;
+    }
+    sha256_init(&base);
+    sha256_update(&base, (const unsigned char *)prefix, (size_t)prefix_len);
+
+    it = PyObject_GetIter(id_list);
+    if (it == NULL)
+        return NULL;
+    result = PyList_New(0);
+    if (result == NULL)
+        goto error;
+    while ((item = PyIter_Next(it)) != NULL) {
+        PyObject *fraction;
+        int rc;
+
+        data = str_utf8(item, &s, &len);
+        Py_DECREF(item);
+        if (data == NULL)
+            goto error;
+        ctx = base;
+        sha256_update(&ctx, (const unsigned char *)data, (size_t)len);
+        Py_DECREF(s);
+        outlen = uniform_of_ctx(&ctx, out);
+        fraction = PyUnicode_FromStringAndSize(out, outlen);
+        if (fraction == NULL)
+            goto error;
+        rc = PyList_Append(result, fraction);
+        Py_DECREF(fraction);
+        if (rc < 0)
+            goto error;
+    }
+    if (PyErr_Occurred())
+        goto error;
+    Py_DECREF(it);
+    return result;
+
+error:
+    Py_XDECREF(it);
+    Py_XDECREF(result);
+    return NULL;
+}
+
+static PyMethodDef kernel_methods[] = {
+    {"sha256_uniform", (PyCFunction)kernel_sha256_uniform, METH_O,
+     sha256_uniform_doc},
+    {"next_fraction", (PyCFunction)kernel_next_fraction, METH_O,
+     next_fraction_doc},
+    {"first_fractions", (PyCFunction)(void (*)(void))kernel_first_fractions,
+     METH_VARARGS | METH_KEYWORDS, first_fractions_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef kernel_module = {
+    PyModuleDef_HEAD_INIT,
+    "_ticket_kernel",
+    "Compiled ticket kernel for consistent_sampler.",
+    -1,
+    kernel_methods
+};
+
+PyMODINIT_FUNC
+PyInit__ticket_kernel(void)
+{
+    return PyModule_Create(&kernel_module);
+}
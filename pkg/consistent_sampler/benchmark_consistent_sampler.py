@@ -0,0 +1,183 @@
+"""Benchmarks for consistent_sampler.py
+
+Run as
+    python benchmark_consistent_sampler.py
+to print the throughput of each hash scheme (see HASH_SCHEMES) for
+the two hashing steps that dominate sampling time: computing first
+tickets for a manifest, and extending ticket chains when sampling
+with replacement; and the time each scheme takes to compute a single
+late-generation ticket with generation_ticket.  With the argument
+--calibrate, it instead measures the costs that sampler's engine
+planner weighs and prints them as an ENGINE_CALIBRATION table, to be
+pasted into consistent_sampler.py (or assigned at run time with
+ENGINE_CALIBRATION.update(calibrate_engines())).
+"""
+
+import heapq
+import math
+import multiprocessing
+import pickle
+import pprint
+import sys
+import time
+
+from consistent_sampler import *
+
+
+def _best_time(routine, repeats):
+    """Return the least time, in seconds, of repeats calls of routine."""
+
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        routine()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def scheme_throughput(n_ids=100000, chain_length=2000, repeats=3):
+    """Return the hashing throughput of each hash scheme.
+
+    Args:
+        n_ids (int): number of ids whose first tickets are computed
+        chain_length (int): number of draws by sampler with replacement,
+            from ids whose ticket chains grow to about 100 generations
+        repeats (int): each measurement is the best of this many runs
+
+    Returns:
+        a dict mapping each scheme name to a pair giving the number of
+        first tickets per second and of next tickets per second.
+    """
+
+    ids = ['{}-{}'.format(i % 97, i) for i in range(n_ids)]
+    results = {}
+    for scheme in HASH_SCHEMES:
+
+        def firsts():
+            first_fractions(ids, 'benchmark seed', scheme=scheme)
+
+        def chain():
+            _chain_tickets(chain_length, scheme)
+
+        results[scheme] = (n_ids / _best_time(firsts, repeats),
+                           chain_length / _best_time(chain, repeats))
+    return results
+
+
+def _chain_tickets(chain_length, scheme):
+    # chain_length draws with replacement from chain_length // 100 ids,
+    # so that each id's ticket chain grows to about 100 generations
+    ids = ['benchmark id {}'.format(i) for i in range(max(chain_length // 100, 1))]
+    for _ in sampler(ids, 'benchmark seed', with_replacement=True,
+                     take=chain_length, scheme=scheme, engine='heap'):
+        pass
+
+
+def print_scheme_throughput(**kwargs):
+    """Print the table of scheme_throughput(**kwargs)."""
+
+    print("{:<14} {:>18} {:>18}".format("scheme", "first tickets/s",
+                                        "next tickets/s"))
+    for scheme, (firsts, nexts) in scheme_throughput(**kwargs).items():
+        print("{:<14} {:>18,.0f} {:>18,.0f}".format(scheme, firsts, nexts))
+
+
+def generation_times(generations=(10, 100, 1000, 10000), repeats=3):
+    """Return the time to compute one ticket of each given generation.
+
+    Returns:
+        a dict mapping each scheme name to a list of times in seconds,
+        one per generation.
+    """
+
+    return {scheme: [_best_time(lambda: generation_ticket(
+                                    'benchmark id', 'benchmark seed', g,
+                                    scheme), repeats)
+                     for g in generations]
+            for scheme in HASH_SCHEMES}
+
+
+def print_generation_times(generations=(10, 100, 1000, 10000), **kwargs):
+    """Print the table of generation_times(generations, **kwargs)."""
+
+    print("{:<14}".format("scheme")
+          + "".join("{:>12}".format("g={}".format(g)) for g in generations))
+    for scheme, times in generation_times(generations, **kwargs).items():
+        print("{:<14}".format(scheme)
+              + "".join("{:>10.2f}ms".format(1000 * t) for t in times))
+
+
+def calibrate_engines(n_ids=100000, repeats=3, scheme=DEFAULT_SCHEME):
+    """Measure the unit costs used by sampler to choose an engine.
+
+    Args:
+        n_ids (int): number of ids used for the measurements
+        repeats (int): each measurement is the best of this many runs
+        scheme (str): the hash scheme measured
+
+    Returns:
+        a dict with the same keys as ENGINE_CALIBRATION, giving
+        seconds per unit on this machine.
+    """
+
+    ids = ['{}-{}'.format(i % 97, i) for i in range(n_ids)]
+    seed = 'benchmark seed'
+    first = _best_time(lambda: first_fractions(ids, seed, scheme=scheme),
+                       repeats) / n_ids
+
+    def per_id(routine):
+        # the cost of routine per id beyond hashing, kept positive
+        return max(_best_time(routine, repeats) / n_ids - first, 1e-9)
+
+    tickets = make_ticket_heap(ids, seed, scheme=scheme)
+
+    def drain():
+        heap = list(tickets)
+        while heap:
+            heapq.heappop(heap)
+
+    def sort_buckets():
+        for _ in bucket_tickets(make_ticket_buckets(ids, seed, scheme)):
+            pass
+
+    def start_workers():
+        with multiprocessing.Pool(2) as pool:
+            pool.map(abs, [1, 2])
+
+    bucket = per_id(lambda: make_ticket_buckets(ids, seed, scheme))
+    return {
+        'first_ticket': first,
+        'select': per_id(lambda: make_ticket_heap(ids, seed, limit=100,
+                                                  scheme=scheme)),
+        'heap_push': per_id(lambda: make_ticket_heap(ids, seed,
+                                                     scheme=scheme)),
+        'heap_pop': _best_time(drain, repeats) / (n_ids * math.log2(n_ids)),
+        'bucket': bucket,
+        'bucket_sort': max(per_id(sort_buckets) - bucket, 1e-9),
+        'next_ticket': _best_time(lambda: [next_ticket(t, scheme)
+                                           for t in tickets],
+                                  repeats) / n_ids,
+        'next_ticket_v2': _best_time(lambda: _chain_tickets(2000,
+                                                            'sha256-v2'),
+                                     repeats) / 2000,
+        'transfer': _best_time(lambda: pickle.loads(pickle.dumps(tickets)),
+                               repeats) / n_ids,
+        'process_start': _best_time(start_workers, repeats) / 2,
+    }
+
+
+def print_engine_calibration(**kwargs):
+    """Print calibrate_engines(**kwargs) as an ENGINE_CALIBRATION table."""
+
+    table = {name: float('{:.3g}'.format(seconds))
+             for name, seconds in calibrate_engines(**kwargs).items()}
+    print("ENGINE_CALIBRATION =", pprint.pformat(table))
+
+
+if __name__ == '__main__':
+    if '--calibrate' in sys.argv[1:]:
+        print_engine_calibration()
+        sys.exit()
+    print_scheme_throughput()
+    print()
+    print_generation_times()
@@ -136,14 +136,65 @@ These ideas are not so new.  They are similar to Python's "decorate
 and sort" paradigm, for example.  See also the references to
 consistent samping in https://arxiv.org/abs/1612.01041.
 
-The main (only) interface routine is the routine "sampler";
-other routines are for internal use only.
+The main interface routine is the routine "sampler".  Other
+interface routines are:
+    export_sample_npz, load_sample_npz:
+        write a sample order to (and read it back from) a columnar
+        NumPy .npz file
+    multi_seed_sampler:
+        sample the same ids under many seeds, as in simulation studies
+    verify_sample:
+        check a published sample against the ids and the seed
+    tally_sampler:
+        count how often each id is drawn, without listing the draws
+    BatchManifest:
+        describes ids compactly as batches of numbered ballots, so that
+        they need not be listed one by one
+    make_sample_order, SampleOrder:
+        compute a sample order once, then take prefixes and subsets
+        of it (such as per-contest orders) without rehashing
+    multi_sampler:
+        sample several overlapping collections (such as contests)
+        at once, hashing each id only once
+    TicketStreamWriter, TicketStreamReader:
+        write and read sample orders in a compact binary format, for
+        shipping them between sites and merging them there
+    BottomKSketch:
+        summarize a collection by its k smallest tickets, to estimate
+        the overlap of large collections without comparing them
+    StreamingSample:
+        keep the first k of the sample order of a growing collection,
+        such as ballots as they are scanned
+    SharedSampleOrder:
+        compute a sample order once for several threads, each reading
+        it with its own cursor
+    publish_sample_order, attach_sample_order:
+        share one computed sample order among several processes,
+        through shared memory
+    generation_ticket:
+        compute TktNo(id, gen) directly, without following the chain
+        of earlier generations (with the 'sha256-v2' scheme)
+Other routines are for internal use only.
 
 """
 
+import array
+import ast
 import collections
+import collections.abc
+import decimal
+import gzip
 import hashlib
 import heapq
+import itertools
+import json
+import math
+import os
+import struct
+import sys
+import tempfile
+import warnings
+import zipfile
 
 
 Ticket = collections.namedtuple("Ticket",
@@ -223,6 +274,184 @@ def duplicates(L):
     return sorted(list(dupes))
 
 
+def _ranges_overlap(a, b):
+    """Return True if ranges a and b have an element in common."""
+
+    if len(a) == 0 or len(b) == 0:
+        return False
+    if a.step == b.step == 1:
+        return a.start < b.stop and b.start < a.stop
+    if len(a) > len(b):
+        a, b = b, a
+    return any(x in b for x in a)
+
+
+class BatchManifest:
+    """A collection of ids given compactly as batches of numbered items.
+
+    Election manifests typically say that "batch B-17 contains ballots
+    1..312" for thousands of batches.  A BatchManifest represents such
+    a manifest without expanding it; its ids are generated one at a
+    time when it is iterated over.  It may be given to sampler (and
+    other routines taking an id_list) in place of the expanded list of
+    ids, with exactly the same results.
+
+    Args:
+        batches (iterable): entries of the forms
+            (batch_id, count): items numbered 1, 2, ..., count
+            (batch_id, numbers): items with numbers in range numbers
+            numbers: a bare range, whose elements are themselves ids
+        id_format (str): format string giving the id of an item in a
+            batch from its batch_id and number, as
+                id_format.format(batch=batch_id, number=number)
+            This should be one-to-one (defaults to '{batch}-{number}',
+            which is, given nonnegative numbers).  If None, the id is
+            the tuple (batch_id, number).  With any other format, the
+            ids are checked to be distinct when the manifest is
+            sampled, as for a list.
+
+    Exceptions:
+        Raises AssertionError if two batches have the same batch_id or
+        two bare ranges overlap, as the ids would then not be distinct;
+        and, with the default id_format, if a batch has a negative
+        number, as ('A', range(-1, 0)) and ('A-', 1) both give 'A--1'.
+
+    Example:
+        >>> manifest = BatchManifest([('B-17', 3), ('C-2', range(5, 7))])
+        >>> len(manifest)
+        5
+        >>> list(manifest)
+        ['B-17-1', 'B-17-2', 'B-17-3', 'C-2-5', 'C-2-6']
+        >>> expanded = list(manifest)
+        >>> (list(sampler(manifest, seed=314159, output='id')) ==
+        ...  list(sampler(expanded, seed=314159, output='id')))
+        True
+    """
+
+    def __init__(self, batches, id_format='{batch}-{number}'):
+        self.id_format = id_format
+        self.batches = []
+        batch_ids = set()
+        bare_ranges = []
+        for entry in batches:
+            if isinstance(entry, range):
+                assert not any(_ranges_overlap(entry, other)
+                               for other in bare_ranges),\
+                    "BatchManifest ranges overlap: {}".format(entry)
+                bare_ranges.append(entry)
+                self.batches.append((None, entry))
+                continue
+            batch_id, numbers = entry
+            if not isinstance(numbers, range):
+                numbers = range(1, numbers + 1)
+            assert (id_format != '{batch}-{number}' or not numbers
+                    or min(numbers[0], numbers[-1]) >= 0),\
+                "BatchManifest batch {!r} has negative numbers"\
+                .format(batch_id)
+            assert batch_id not in batch_ids,\
+                "BatchManifest contains duplicate batch id: {}"\
+                .format(batch_id)
+            batch_ids.add(batch_id)
+            self.batches.append((batch_id, numbers))
+
+    def __len__(self):
+        return sum(len(numbers) for _, numbers in self.batches)
+
+    def __iter__(self):
+        id_format = self.id_format
+        for batch_id, numbers in self.batches:
+            if batch_id is None:
+                yield from numbers
+            elif id_format is None:
+                for number in numbers:
+                    yield (batch_id, number)
+            else:
+                for number in numbers:
+                    yield id_format.format(batch=batch_id, number=number)
+
+    def __repr__(self):
+        return "BatchManifest({!r}, id_format={!r})"\
+            .format(self.batches, self.id_format)
+
+
+def _assert_distinct(id_list, routine):
+    """Check that the ids in id_list are distinct, for the named routine.
+
+    A range, or a BatchManifest with the default (or no) id_format,
+    has distinct ids by construction, and is not expanded into a set
+    for the check.
+    """
+
+    if isinstance(id_list, range):
+        return
+    if (isinstance(id_list, BatchManifest)
+            and id_list.id_format in (None, '{batch}-{number}')):
+        return
+    assert len(id_list) == len(set(id_list)),\
+        "Input id_list to {} contains duplicate ids: {}"\
+        .format(routine, duplicates(id_list))
+
+
+def _blake2b_256(data=b''):
+    """Return a BLAKE2b hash object with a 256-bit digest."""
+
+    return hashlib.blake2b(data, digest_size=32)
+
+
+HASH_SCHEMES = {
+    'sha256-v1': hashlib.sha256,
+    'blake2b-v1': _blake2b_256,
+    'sha256-v2': hashlib.sha256,
+}
+"""
+The hash schemes for ticket numbers, by name.  Each maps to a hashlib
+constructor for a 256-bit hash.  For the '-v1' schemes the ticket
+numbers are made from that hash exactly as described above for
+SHA256.  The version suffix names the construction, so that a sample
+drawn under a given scheme can always be reproduced.  'blake2b-v1' is
+an opt-in alternative to the default, and gives different ticket
+numbers.  'sha256-v2' gives the same first tickets as 'sha256-v1',
+but computes later generations directly from the first ticket (see
+generation_ticket) rather than each from the one before.  That
+reaches one late generation far sooner (about 3 ms for generation
+1000, against 11 ms with 'sha256-v1'), but makes each successive
+draw when sampling with replacement some 8 times costlier (about
+0.09 ms, against 0.012 ms), so it pays off only when single
+generations in the hundreds or more are wanted.
+"""
+
+_KERNEL_SCHEMES = frozenset({'sha256-v1', 'sha256-v2'})
+# Schemes whose hash is SHA256, as computed by the compiled kernel.
+
+_RANDOM_ACCESS_SCHEMES = frozenset({'sha256-v2'})
+# Schemes computing TktNo(id, g) directly from TktNo(id, 1) and g.
+
+DEFAULT_SCHEME = 'sha256-v1'
+"""
+The hash scheme used unless another is requested.
+"""
+
+
+def _scheme_hash(scheme):
+    """Return the hashlib constructor for the named hash scheme."""
+
+    assert scheme in HASH_SCHEMES,\
+        "unknown hash scheme {!r}; known schemes are {}"\
+        .format(scheme, sorted(HASH_SCHEMES))
+    return HASH_SCHEMES[scheme]
+
+
+def hash_hex(hash_input, scheme=DEFAULT_SCHEME):
+    """Return 64-character hex hash of input under the given scheme.
+
+    Example:
+        >>> hash_hex("abc", 'blake2b-v1')
+        'bddd813c634239723171ef3fee98579b94964e3bb1cb3e427262c8c068d52319'
+    """
+
+    return _scheme_hash(scheme)(str(hash_input).encode('utf-8')).hexdigest()
+
+
 def sha256_hex(hash_input):
     """ Return 64-character hex representation of SHA256 of input.
 
@@ -241,12 +470,15 @@ def sha256_hex(hash_input):
     return hashlib.sha256(str(hash_input).encode('utf-8')).hexdigest()
 
 
-def sha256_uniform(hash_input):
+def sha256_uniform(hash_input, scheme=DEFAULT_SCHEME):
     """
     Return SHA256 hash of input as string representation of real in (0, 1).
 
     Args:
         hash_input (obj): a python object with a string representation
+        scheme (str): the hash scheme (see HASH_SCHEMES), which gives
+            the hash used: SHA256 for 'sha256-v1' and 'sha256-v2',
+            BLAKE2b for 'blake2b-v1'
 
     Returns:
         a string represention of the form '0.dddd...dddd'
@@ -263,16 +495,23 @@ def sha256_uniform(hash_input):
     reasons of clarity) gives biased high-order digits.  Reversing the
     string puts the low-order unbiased digits first, while losing no
     information.
+    Only the decimal conversion of the 256-bit hash value is done
+    per call; the digits are reversed by slicing rather than via a
+    list, and the hex form of the hash is not materialized.
     """
 
-    x_hex = sha256_hex(hash_input)
-    x_int = ("{:064d}".format(int(x_hex, 16)))
-    x_list = list(x_int)
-    x_list.reverse()
-    return "0." + "".join(x_list)
+    return _digest_uniform(
+        _scheme_hash(scheme)(str(hash_input).encode('utf-8')).digest())
+
+
+def _digest_uniform(x_bytes):
+    """Return '0.ddd...ddd' for a 256-bit digest, as in sha256_uniform."""
+
+    x_int = int.from_bytes(x_bytes, 'big')
+    return "0." + "{:064d}".format(x_int)[::-1]
 
 
-def first_fraction(id, seed, seed_hash=None):
+def first_fraction(id, seed, seed_hash=None, scheme=DEFAULT_SCHEME):
     """ Return initial pseudo-random fraction for given id and seed.
 
     Args:
@@ -281,6 +520,7 @@ def first_fraction(id, seed, seed_hash=None):
         seed_hash (obj): if the caller has already hashed the seed
             (for efficiency), then providing seed_hash saves the
             need for recomputing it.
+        scheme (str): the hash scheme (see HASH_SCHEMES)
 
     Returns:
         A real number in (0,1) represented as '0.dddd...dddd'
@@ -293,16 +533,64 @@ def first_fraction(id, seed, seed_hash=None):
     """
 
     if seed_hash is None:
-        seed_hash = sha256_hex(seed)
-    return sha256_uniform(seed_hash + str(id))
+        seed_hash = hash_hex(seed, scheme)
+    return sha256_uniform(seed_hash + str(id), scheme)
+
+
+def first_fractions(id_list, seed, seed_hash=None, scheme=DEFAULT_SCHEME):
+    """ Return list of initial pseudo-random fractions for the given ids.
+
+    Args:
+        id_list (iterable): hashable python objects with string
+            representations
+        seed (obj): a python object with a string represetation
+        seed_hash (obj): optional precomputed hash_hex(seed, scheme)
+        scheme (str): the hash scheme (see HASH_SCHEMES)
+
+    Returns:
+        A list giving first_fraction(id, seed) for each id in id_list,
+        in the same order.  This bulk form lets the compiled ticket
+        kernel (if available) hash a whole manifest in one call.
+
+    Example:
+        >>> first_fractions(['AB-130'], '01382438112797316654')
+        ['0.26299714122838008416507544297546663599715395525154425586041245287750224561854']
+    """
+
+    if seed_hash is None:
+        seed_hash = hash_hex(seed, scheme)
+    return _encoded_first_fractions(
+        [str(id).encode('utf-8') for id in id_list], seed_hash, scheme)
+
+
+def _encoded_first_fractions(encoded_ids, seed_hash, scheme=DEFAULT_SCHEME):
+    """Return first fractions for ids already encoded as utf-8 bytes.
+
+    Args:
+        encoded_ids (list): the bytes str(id).encode('utf-8') for each id
+        seed_hash (str): hash_hex of the seed
+        scheme (str): the hash scheme
+
+    Returns:
+        the same list as first_fractions would give for these ids.
+    """
 
+    prefix = _scheme_hash(scheme)(seed_hash.encode('utf-8'))
+    fractions = []
+    for id_bytes in encoded_ids:
+        h = prefix.copy()
+        h.update(id_bytes)
+        fractions.append(_digest_uniform(h.digest()))
+    return fractions
 
-def next_fraction(x):
+
+def next_fraction(x, scheme=DEFAULT_SCHEME):
     """ Return pseudorandom real y in (x, 1) (so y>x).
 
     Args:
         x (str): An input string of the form "0.ddd...dddd"
             representing a real number in (0,1).
+        scheme (str): the hash scheme (see HASH_SCHEMES)
 
     Returns:
         a string y of the form '0.dddd..dddd' chosen pseudorandomly
@@ -312,6 +600,9 @@ def next_fraction(x):
         Repeatedly replacing all but the initial segment of 9s in
         x with the output of the digits of sha256_uniform in counter
         mode, until the result is larger than x.
+        For a random-access scheme such as 'sha256-v2', x is taken
+        to be a first ticket number and y is the generation 2 ticket
+        number given by generation_ticket.
 
     Example:
         >>> next_fraction('0.25471')
@@ -319,6 +610,8 @@ def next_fraction(x):
     """
 
     assert x[:2] == '0.'
+    if scheme in _RANDOM_ACCESS_SCHEMES:
+        return _generation_fraction(x, 2, scheme)
     x0 = x+'0'          # in case x mantissa is all 9s
     first_non_9_position = \
         min([i for i in range(2, len(x0)) if x0[i] < '9'])
@@ -327,18 +620,132 @@ def next_fraction(x):
     while y <= x0:
         i = i + 1
         y = x0[:first_non_9_position]
-        y = y + sha256_uniform(x + ':' + str(i))[2:]
+        y = y + sha256_uniform(x + ':' + str(i), scheme)[2:]
     return y
 
 
-def first_ticket(id, seed, seed_hash=None):
+# The pure-Python routines above are the reference implementation.
+# If the optional compiled ticket kernel has been built (see setup.py),
+# its identical but faster versions replace them here for the schemes
+# using SHA256 (and, for next_fraction, only for 'sha256-v1').
+
+_py_sha256_uniform = sha256_uniform
+_py_first_fractions = first_fractions
+_py_next_fraction = next_fraction
+
+try:
+    from . import _ticket_kernel
+except ImportError:
+    try:
+        import _ticket_kernel
+    except ImportError:
+        _ticket_kernel = None
+
+if _ticket_kernel is not None:
+
+    def sha256_uniform(hash_input, scheme=DEFAULT_SCHEME):
+        if scheme in _KERNEL_SCHEMES:
+            return _ticket_kernel.sha256_uniform(hash_input)
+        return _py_sha256_uniform(hash_input, scheme)
+
+    def first_fractions(id_list, seed, seed_hash=None, scheme=DEFAULT_SCHEME):
+        if scheme in _KERNEL_SCHEMES:
+            return _ticket_kernel.first_fractions(id_list, seed, seed_hash)
+        return _py_first_fractions(id_list, seed, seed_hash, scheme)
+
+    def next_fraction(x, scheme=DEFAULT_SCHEME):
+        if scheme == 'sha256-v1':
+            return _ticket_kernel.next_fraction(x)
+        return _py_next_fraction(x, scheme)
+
+    sha256_uniform.__doc__ = _py_sha256_uniform.__doc__
+    first_fractions.__doc__ = _py_first_fractions.__doc__
+    next_fraction.__doc__ = _py_next_fraction.__doc__
+
+
+_KERNEL_NOT_LOADED = 'skipped: the compiled ticket kernel is not loaded'
+"""
+Returned by _kernel_mismatches when there is no kernel to check.
+"""
+
+
+def _kernel_mismatches(trials=300, rng_seed=1):
+    """Return inputs on which the ticket kernel and Python code disagree.
+
+    Runs the selected sha256_uniform, first_fractions and next_fraction
+    against the pure-Python reference versions on pseudorandom inputs.
+
+    Args:
+        trials (int): number of random inputs per routine
+        rng_seed (int): seed for the input generator
+
+    Returns:
+        a list of (routine name, input) pairs; empty if all agree.
+        If the compiled kernel is not loaded (it is optional, and not
+        built without a C compiler) there is nothing to compare:
+        _KERNEL_NOT_LOADED is returned instead, and a RuntimeWarning
+        says so, so that a test run shows that the check was skipped.
+
+    Example:
+        >>> _kernel_mismatches() in ([], _KERNEL_NOT_LOADED)
+        True
+        >>> _ticket_kernel is None or _kernel_mismatches() == []
+        True
+    """
+
+    if _ticket_kernel is None:
+        warnings.warn(_KERNEL_NOT_LOADED, RuntimeWarning)
+        return _KERNEL_NOT_LOADED
+
+    import random
+    rng = random.Random(rng_seed)
+    alphabet = "0123456789abcXYZ-:#. \u00e9\u4e2d"
+
+    def random_obj():
+        choice = rng.randrange(4)
+        if choice == 0:
+            return rng.randrange(-10**30, 10**30)
+        text = "".join(rng.choice(alphabet)
+                       for _ in range(rng.randrange(0, 150)))
+        if choice == 1:
+            return (text, rng.randrange(100))
+        return text
+
+    def random_fraction():
+        nines = "9" * rng.choice([0, 0, 1, 2, 5, 30, 70])
+        tail = "".join(rng.choice("0123456789")
+                       for _ in range(rng.randrange(0, 90)))
+        return "0." + nines + tail
+
+    mismatches = []
+    for _ in range(trials):
+        x = random_obj()
+        if sha256_uniform(x) != _py_sha256_uniform(x):
+            mismatches.append(('sha256_uniform', x))
+        x = random_fraction()
+        if next_fraction(x) != _py_next_fraction(x):
+            mismatches.append(('next_fraction', x))
+    for _ in range(trials // 10):
+        ids = [random_obj() for _ in range(rng.randrange(0, 20))]
+        seed = random_obj()
+        if first_fractions(ids, seed) != _py_first_fractions(ids, seed):
+            mismatches.append(('first_fractions', (ids, seed)))
+        seed_hash = sha256_hex(seed)
+        if first_fractions(ids, seed, seed_hash) != \
+                _py_first_fractions(ids, seed, seed_hash):
+            mismatches.append(('first_fractions', (ids, seed_hash)))
+    return mismatches
+
+
+def first_ticket(id, seed, seed_hash=None, scheme=DEFAULT_SCHEME):
     """Return initial (generation 1) ticket for the given id and seed.
 
     Args:
         id (str): a hashable python object with a string representation
         seed (str): a python object with a string representation
         seed_hash (str): the caller may for efficiency supply the
-            sha256_hex hash for seed, so it doesn't need to be recomputed
+            hash_hex hash for seed, so it doesn't need to be recomputed
+        scheme (str): the hash scheme (see HASH_SCHEMES)
 
     Returns:
         a Ticket that is the first-generation ticket for the given
@@ -349,14 +756,18 @@ def first_ticket(id, seed, seed_hash=None):
         Ticket(ticket_number='0.26299714122838008416507544297546663599715395525154425586041245287750224561854', id='AB-130', generation=1)
     """
 
-    return Ticket(first_fraction(id, seed, seed_hash), id, 1)
+    return Ticket(first_fraction(id, seed, seed_hash, scheme), id, 1)
 
 
-def next_ticket(ticket):
+def next_ticket(ticket, scheme=DEFAULT_SCHEME, first_number=None):
     """Return the next ticket for the given ticket.
 
     Args:
         ticket (Ticket): an arbitrary ticket
+        scheme (str): the hash scheme (see HASH_SCHEMES)
+        first_number (str): for a random-access scheme such as
+            'sha256-v2', the first ticket number of ticket.id; it may
+            be omitted when ticket is itself a first ticket
 
     Returns:
         the next ticket in the chain of tickets, having the next
@@ -368,18 +779,350 @@ def next_ticket(ticket):
         Ticket(ticket_number='0.8232357229934205790595761924514048157652891124687533667363938813600770093316', id='AB-130', generation=2)
     """
 
-    return Ticket(next_fraction(ticket.ticket_number),
+    if scheme in _RANDOM_ACCESS_SCHEMES:
+        if first_number is None:
+            assert ticket.generation == 1,\
+                "next_ticket needs first_number for scheme " + scheme
+            first_number = ticket.ticket_number
+        return Ticket(_generation_fraction(first_number,
+                                           ticket.generation + 1, scheme),
+                      ticket.id,
+                      ticket.generation + 1)
+    return Ticket(next_fraction(ticket.ticket_number, scheme),
                   ticket.id,
                   ticket.generation+1)
 
 
-def make_ticket_heap(id_list, seed):
+def _next_chain_ticket(ticket, scheme, first_numbers):
+    """Return next_ticket(ticket, scheme) for a ticket in a chain.
+
+    Random-access schemes compute later tickets from the first ticket
+    number of the id, so first_numbers (a dict mapping ids to the
+    _Arrivals of their first ticket numbers) records it when a first
+    ticket is passed in, and supplies it for later ones, along with
+    the work already done for the id's earlier generations.  Other
+    schemes ignore first_numbers.
+    """
+
+    if scheme not in _RANDOM_ACCESS_SCHEMES:
+        return next_ticket(ticket, scheme)
+    if ticket.generation == 1:
+        first_numbers[ticket.id] = _Arrivals(ticket.ticket_number, scheme)
+    return Ticket(first_numbers[ticket.id].fraction(ticket.generation + 1),
+                  ticket.id,
+                  ticket.generation + 1)
+
+
+# Random-access generations ('sha256-v2').
+#
+# With replacement, the values E_g = -ln(1 - TktNo(id, g)) for
+# g = 1, 2, ... are the points of a rate-one Poisson process (see
+# _replacement_cutoff).  Given E_1, the offsets E_g - E_1 for g >= 2
+# are the arrival times S_1 < S_2 < ... of a rate-one Poisson process
+# on (0, inf).  The '-v2' schemes fix one realization of that process
+# per id, hashing (from the first ticket number) only the parts of it
+# needed to locate the kth arrival:
+#   -- the time axis is cut into blocks [2**m - 1, 2**(m+1) - 1),
+#      m = 0, 1, 2, ..., whose arrival counts are independent
+#      Poisson(2**m) variates;
+#   -- within the block holding the kth arrival, a binary tree of
+#      halving intervals splits each count with a Binomial(n, 1/2)
+#      variate, down to a unit interval;
+#   -- the arrivals in that unit interval are sorted uniform variates.
+# Each variate is drawn by inverting its distribution function at a
+# uniform (0, 1) value from sha256_uniform, so TktNo(id, g) takes
+# O(log g) hashes, and the tickets of an id increase with g.  Decimal
+# arithmetic (whose exp and ln are correctly rounded) keeps the
+# results the same on every platform.
+
+_V2_PRECISION = 90
+# Significant digits carried in '-v2' generation arithmetic.
+
+_V2_TAIL = decimal.Decimal(10) ** -80
+# Probabilities below this are negligible when inverting distributions.
+
+_LN_2PI = None
+# ln(2*pi) to _V2_PRECISION digits, computed when first needed.
+
+_V2_MEMO = {}
+# Maps (name, argument, context precision) to a Decimal computed by
+# _ln_factorial, _poisson_quantile or _binomial_half_quantile, which
+# use the same few arguments (block means, and counts) over and over.
+
+
+def _ln_factorial(n):
+    """Return ln(n!) as a Decimal, to the current context precision."""
+
+    key = ('ln_factorial', n, decimal.getcontext().prec)
+    if key in _V2_MEMO:
+        return _V2_MEMO[key]
+    if n < 1000:
+        result = decimal.Decimal(math.factorial(n)).ln()
+        _V2_MEMO[key] = result
+        return result
+    global _LN_2PI
+    if _LN_2PI is None:
+        _LN_2PI = (2 * decimal.Decimal(
+            '3.14159265358979323846264338327950288419716939937510'
+            '58209749445923078164062862089986280348253421170679')).ln()
+    # Stirling's series; with n >= 1000 the omitted terms are < 1e-100.
+    x = decimal.Decimal(n)
+    result = (x + decimal.Decimal('0.5')) * x.ln() - x + _LN_2PI / 2
+    for numerator, denominator, power in ((1, 12, 1), (-1, 360, 3),
+                                          (1, 1260, 5), (-1, 1680, 7),
+                                          (1, 1188, 9), (-691, 360360, 11),
+                                          (1, 156, 13), (-3617, 122400, 15)):
+        result += decimal.Decimal(numerator) / (denominator * x ** power)
+    _V2_MEMO[key] = result
+    return result
+
+
+def _discrete_quantile(u, mode, pmf_mode, down, up):
+    """Return the least x with P(X <= x) >= u, for a unimodal X >= 0.
+
+    Args:
+        u (Decimal): a probability in (0, 1)
+        mode (int): a mode of X
+        pmf_mode (Decimal): P(X = mode)
+        down (function): down(i) gives P(X = i-1) / P(X = i)
+        up (function): up(i) gives P(X = i+1) / P(X = i)
+
+    Returns:
+        the quantile, summing probabilities outward from the mode
+        (so taking O(standard deviation) steps) and neglecting those
+        below _V2_TAIL.
+    """
+
+    lower = [pmf_mode]          # P(X = mode), P(X = mode-1), ...
+    p = pmf_mode
+    for i in range(mode, 0, -1):
+        p *= down(i)
+        if p < _V2_TAIL:
+            break
+        lower.append(p)
+    cdf = sum(lower)            # P(X <= mode)
+    x = mode
+    if u <= cdf:
+        for p in lower:
+            if cdf - p < u:
+                return x
+            cdf -= p
+            x -= 1
+        return x + 1
+    p = pmf_mode
+    while cdf < u:
+        p *= up(x)
+        x += 1
+        cdf += p
+        if p < _V2_TAIL:
+            break
+    return x
+
+
+def _poisson_quantile(u, mean):
+    """Return the u-quantile of the Poisson distribution with integer mean."""
+
+    lam = decimal.Decimal(mean)
+    key = ('poisson', mean, decimal.getcontext().prec)
+    if key not in _V2_MEMO:
+        _V2_MEMO[key] = (mean * lam.ln() - lam - _ln_factorial(mean)).exp()
+    return _discrete_quantile(u, mean, _V2_MEMO[key],
+                              lambda i: i / lam,
+                              lambda i: lam / (i + 1))
+
+
+def _binomial_half_quantile(u, n):
+    """Return the u-quantile of the Binomial(n, 1/2) distribution."""
+
+    mode = n // 2
+    key = ('binomial_half', n, decimal.getcontext().prec)
+    if key not in _V2_MEMO:
+        _V2_MEMO[key] = (_ln_factorial(n) - _ln_factorial(mode)
+                         - _ln_factorial(n - mode)
+                         - n * decimal.Decimal(2).ln()).exp()
+    return _discrete_quantile(u, mode, _V2_MEMO[key],
+                              lambda i: decimal.Decimal(i) / (n - i + 1),
+                              lambda i: decimal.Decimal(n - i) / (i + 1))
+
+
+class _Arrivals:
+    """The Poisson process of one id under a random-access scheme.
+
+    Computes the arrival times S_k and tickets TktNo(id, g) from the
+    first ticket number (see the notes above), keeping the variates
+    it has drawn so that a chain of consecutive generations does not
+    redraw them: the block counts, the binomial splits on the path
+    to the latest unit interval, and the sorted arrivals in it.
+    These take O(log g) space, so one _Arrivals per id is cheap to
+    keep (and to pickle, as _chain_segment does).
+
+    Attributes:
+        first_number (str): TktNo(id, 1)
+        scheme (str): the hash scheme
+    """
+
+    __slots__ = ('first_number', 'scheme', 'counts', 'path', 'unit')
+
+    def __init__(self, first_number, scheme):
+        self.first_number = first_number
+        self.scheme = scheme
+        self.counts = []        # Poisson count of block m, m = 0, 1, ...
+        self.path = []          # (low, length, left) splits, root first
+        self.unit = None        # (low, sorted arrivals) of a unit interval
+
+    def _uniform(self, label):
+        return decimal.Decimal(sha256_uniform(
+            self.first_number + ':v2:' + label, self.scheme))
+
+    def offset(self, k):
+        """Return the kth arrival time S_k, as a Decimal."""
+
+        before = 0
+        m = 0
+        while True:
+            if m == len(self.counts):
+                self.counts.append(_poisson_quantile(
+                    self._uniform('P{}'.format(m)), 2 ** m))
+            count = self.counts[m]
+            if before + count >= k:
+                break
+            before += count
+            m += 1
+        low = 2 ** m - 1
+        length = 2 ** m
+        n = count
+        rank = k - before
+        depth = 0
+        while length > 1:
+            length //= 2
+            if (depth < len(self.path)
+                    and self.path[depth][:2] == (low, length)):
+                left = self.path[depth][2]
+            else:
+                del self.path[depth:]
+                left = _binomial_half_quantile(
+                    self._uniform('B{}:{}'.format(low, length)), n)
+                self.path.append((low, length, left))
+            depth += 1
+            if rank <= left:
+                n = left
+            else:
+                rank -= left
+                n -= left
+                low += length
+        if self.unit is None or self.unit[0] != low:
+            self.unit = (low, sorted(self._uniform('U{}:{}'.format(low, i))
+                                     for i in range(n)))
+        return low + self.unit[1][rank - 1]
+
+    def fraction(self, generation):
+        """Return TktNo(id, generation)."""
+
+        first_number = self.first_number
+        if generation == 1:
+            return first_number
+        with decimal.localcontext() as context:
+            context.prec = _V2_PRECISION
+            offset = self.offset(generation - 1)
+            # 1 - TktNo(id, g) = (1 - TktNo(id, 1)) * exp(-S_(g-1))
+            context.prec = max(_V2_PRECISION, len(first_number))
+            gap = 1 - decimal.Decimal(first_number)
+            context.prec = _V2_PRECISION
+            gap = gap * (-offset).exp()
+            context.prec = _V2_PRECISION - gap.adjusted()
+            number = format(1 - gap, 'f')
+        return number.rstrip('0')
+
+
+def _generation_fraction(first_number, generation, scheme):
+    """Return TktNo(id, generation) for a random-access scheme, given
+    first_number = TktNo(id, 1)."""
+
+    return _Arrivals(first_number, scheme).fraction(generation)
+
+
+def generation_ticket(id, seed, generation, scheme='sha256-v2',
+                      seed_hash=None):
+    """Return the ticket of the given generation for id and seed.
+
+    For a random-access scheme such as 'sha256-v2' the ticket is
+    computed directly, with O(log generation) hashes; for other
+    schemes the chain of tickets is followed from the first.
+
+    Args:
+        id (obj): a hashable python object with a string representation
+        seed (obj): the seed
+        generation (int): a positive integer
+        scheme (str): the hash scheme (see HASH_SCHEMES); note that
+            the default here is 'sha256-v2', not DEFAULT_SCHEME
+        seed_hash (str): optional precomputed hash_hex(seed, scheme)
+
+    Returns:
+        the Ticket TktNo(id, generation), equal to the ticket that
+        sampler (with the same scheme) gives id in that generation.
+
+    Example:
+        >>> ticket = generation_ticket('AB-130', '01382438112797316654',
+        ...                            1000)
+        >>> ticket.generation, len(ticket.ticket_number)
+        (1000, 530)
+        >>> ticket.ticket_number < generation_ticket(
+        ...     'AB-130', '01382438112797316654', 1001).ticket_number
+        True
+        >>> generation_ticket('AB-130', '01382438112797316654', 1) == \\
+        ...     first_ticket('AB-130', '01382438112797316654')
+        True
+    """
+
+    assert type(generation) is int and generation > 0
+    ticket = first_ticket(id, seed, seed_hash, scheme)
+    if scheme in _RANDOM_ACCESS_SCHEMES:
+        return Ticket(_generation_fraction(ticket.ticket_number,
+                                           generation, scheme),
+                      id, generation)
+    while ticket.generation < generation:
+        ticket = next_ticket(ticket, scheme)
+    return ticket
+
+
+def _iter_first_tickets(id_list, seed, chunk_size=4096, scheme=DEFAULT_SCHEME):
+    """Generate the first-generation Ticket for each id in id_list.
+
+    The ids are hashed in bulk, chunk_size at a time, so only one
+    chunk of ticket numbers is held in memory at once.
+    """
+
+    seed_hash = hash_hex(seed, scheme)
+    ids = iter(id_list)
+    while True:
+        chunk = list(itertools.islice(ids, chunk_size))
+        if not chunk:
+            return
+        fractions = first_fractions(chunk, seed, seed_hash, scheme)
+        yield from map(Ticket, fractions, chunk, itertools.repeat(1))
+
+
+def make_ticket_heap(id_list, seed, limit=None, scheme=DEFAULT_SCHEME,
+                     checkpoint=None, checkpoint_interval=1 << 20):
     """Make a heap containing one ticket for each id in id_list.
 
     Args:
         id_list (iterable): a list or iterable with a list of distinct 
             hashable ids
         seed (str): a string or any printable python object.
+        limit (int): if given, only the limit tickets with smallest
+            ticket numbers are kept, using O(limit) memory.
+        scheme (str): the hash scheme (see HASH_SCHEMES)
+        checkpoint (str): if given (which requires limit), the name of
+            a checkpoint file, rewritten (atomically) after every
+            checkpoint_interval ids with the number of ids done and
+            the positions in id_list of the tickets kept so far.  If
+            the file exists, the work resumes from it, skipping the
+            ids already done without hashing them, and gives the same
+            result as an uninterrupted call.  The file is left in
+            place for the caller to remove.
+        checkpoint_interval (int): the number of ids between
+            checkpoints
 
     Returns:
         a list that is a min-heap created by heapq with one ticket per id
@@ -387,6 +1130,8 @@ def make_ticket_heap(id_list, seed):
             By the heap property, the ticket_number at position i will be
             less than or equal to the ticket_numbers at positions 2i+1
             and 2i+2.
+            If limit is given, the list is in sorted order (which is
+            also a heap) and has at most limit tickets.
 
     Example:
     >>> heap = make_ticket_heap(['dog', 'cat', 'fish', 'goat'], 'xy()134!g2n')
@@ -396,113 +1141,855 @@ def make_ticket_heap(id_list, seed):
     Ticket(ticket_number='0.33886035615681875183111698317327684455682722683976874746986356932751818935066', id='dog', generation=1)
     Ticket(ticket_number='0.74685932088827950509145941729789143204056041958068799542050396198792954500593', id='fish', generation=1)
     Ticket(ticket_number='0.49599842072022713663423753308080171636735689997237236247068925068573448764387', id='goat', generation=1)
+
+    A build interrupted after a checkpoint resumes where it left off:
+    >>> def ids_until_crash():
+    ...     yield from range(6000)
+    ...     raise RuntimeError("crash")
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> path = os.path.join(directory.name, 'heap.checkpoint')
+    >>> make_ticket_heap(ids_until_crash(), 1, limit=3, checkpoint=path,
+    ...                  checkpoint_interval=4096)
+    Traceback (most recent call last):
+    ...
+    RuntimeError: crash
+    >>> resumed = make_ticket_heap(range(10000), 1, limit=3, checkpoint=path,
+    ...                            checkpoint_interval=4096)
+    >>> resumed == make_ticket_heap(range(10000), 1, limit=3)
+    True
+    >>> directory.cleanup()
     """
 
+    if checkpoint is not None:
+        assert limit is not None, "make_ticket_heap checkpoints need a limit"
+        return _checkpointed_selection(id_list, seed, limit, scheme,
+                                       checkpoint, checkpoint_interval)
+    if limit is not None:
+        return heapq.nsmallest(
+            limit, _iter_first_tickets(id_list, seed, scheme=scheme))
+
     heap = []
-    seed_hash = sha256_hex(seed)
-    for id in id_list:
-        heapq.heappush(heap, first_ticket(id, seed, seed_hash))
+    if not isinstance(id_list, collections.abc.Sequence):
+        id_list = list(id_list)
+    fractions = first_fractions(id_list, seed, scheme=scheme)
+    for id, fraction in zip(id_list, fractions):
+        heapq.heappush(heap, Ticket(fraction, id, 1))
     return heap
 
 
-def draw_without_replacement(heap):
-    """Return ticket drawn without replacement from given heap of tickets.
+def _checkpointed_selection(id_list, seed, limit, scheme, checkpoint,
+                            interval, chunk_size=4096):
+    """Return make_ticket_heap(id_list, seed, limit, scheme), saving and
+    resuming progress with the given checkpoint file.
 
-    Args:
-        heap (list): an array of Tickets, arranged into a heap using heapq.
-            Such a heap is also known as a 'priority queue'.
+    The selection is held as (Ticket, position) pairs, so a checkpoint
+    need only list positions in id_list; on resuming, the ids at those
+    positions are picked out while skipping the ids already done, and
+    just their tickets are recomputed.
+    """
 
-    Returns:
-        the Ticket with the least ticket number in the heap.
+    assert type(interval) is int and interval > 0
+    identity = {'routine': 'make_ticket_heap', 'limit': limit,
+                'seed_hash': hash_hex(seed, scheme), 'scheme': scheme}
+    seed_hash = identity['seed_hash']
+    ids = iter(id_list)
+    selection = []
+    offset = 0
+    state = _read_checkpoint(checkpoint, identity)
+    if state is not None:
+        offset = state['offset']
+        positions = set(state['positions'])
+        kept = [(position, id)
+                for position, id in enumerate(itertools.islice(ids, offset))
+                if position in positions]
+        assert len(kept) == len(positions),\
+            "id_list is shorter than when checkpoint {} was made"\
+            .format(checkpoint)
+        fractions = first_fractions([id for _, id in kept], seed, seed_hash,
+                                    scheme)
+        selection = sorted((Ticket(fraction, id, 1), position)
+                           for fraction, (position, id) in zip(fractions,
+                                                               kept))
+        if state['complete']:
+            return [ticket for ticket, _ in selection]
 
-    Side-effects:
-        the heap is reduced in size by one, as the drawn ticket is not
-        replaced.
+    next_checkpoint = offset + interval
+    while True:
+        chunk = list(itertools.islice(ids, chunk_size))
+        if chunk:
+            fractions = first_fractions(chunk, seed, seed_hash, scheme)
+            candidates = [(Ticket(fraction, id, 1), position)
+                          for position, (fraction, id)
+                          in enumerate(zip(fractions, chunk), offset)]
+            if limit and len(selection) == limit:
+                threshold = selection[-1]
+                candidates = [c for c in candidates if c < threshold]
+            if candidates:
+                selection = heapq.nsmallest(limit, selection + candidates)
+            offset += len(chunk)
+        if not chunk or offset >= next_checkpoint:
+            _write_checkpoint(checkpoint, identity, offset=offset,
+                              positions=[p for _, p in selection],
+                              complete=not chunk)
+            next_checkpoint = offset + interval
+        if not chunk:
+            return [ticket for ticket, _ in selection]
 
-    Example:
-        >>> x = Ticket('0.234', 'x', 2)
-        >>> y = Ticket('0.354', 'y', 1)
-        >>> z = Ticket('0.666', 'z', 2)
-        >>> heap = []
-        >>> heapq.heappush(heap, x)
-        >>> heapq.heappush(heap, y)
-        >>> heapq.heappush(heap, z)
-        >>> for ticket in heap:
-        ...     print(ticket)
-        Ticket(ticket_number='0.234', id='x', generation=2)
-        Ticket(ticket_number='0.354', id='y', generation=1)
-        Ticket(ticket_number='0.666', id='z', generation=2)
-        >>> draw_without_replacement(heap)
-        Ticket(ticket_number='0.234', id='x', generation=2)
-    """
 
-    ticket = heapq.heappop(heap)
-    return ticket
+def _bucket_digits(n):
+    """Return the number of leading digits to bucket n tickets by:
+    enough for about 1 to 10 tickets per bucket, up to a million
+    buckets."""
 
+    return min(max(len(str(n)) - 1, 1), 6)
+
+
+def _fill_buckets(buckets, ids, seed, digits, scheme, chunk_size=4096):
+    """Hash the ids and append their first tickets to buckets, a list
+    of 10**digits lists."""
+
+    seed_hash = hash_hex(seed, scheme)
+    stop = 2 + digits
+    ids = iter(ids)
+    while True:
+        chunk = list(itertools.islice(ids, chunk_size))
+        if not chunk:
+            return
+        # first-ticket numbers have at least 64 digits (see
+        # sha256_uniform), so the slice is always digits long
+        for fraction, id in zip(first_fractions(chunk, seed, seed_hash,
+                                                scheme), chunk):
+            buckets[int(fraction[2:stop])].append(Ticket(fraction, id, 1))
 
-def draw_with_replacement(heap):
-    """Return ticket drawn with replacement from given heap of tickets.
+
+def _bucket_segment(segment):
+    """Hash the ids of one segment and group their tickets by bucket.
 
     Args:
-        heap (list): an array of Tickets, arranged into a heap using heapq.
-            Such a heap is also known as a 'priority queue'.
+        segment (tuple): (ids, seed, digits, scheme)
 
     Returns:
-        the Ticket with the least ticket number in the heap.
+        a list of (bucket index, list of Tickets) pairs, for the
+        nonempty buckets only.  Module-level so it can be used with
+        multiprocessing.Pool.map.
+    """
 
-    Side-effects:
-        the heap maintains its size, as the drawn ticket is replaced
-            in the heap by the next ticket for that id.
+    ids, seed, digits, scheme = segment
+    buckets = [[] for _ in range(10 ** digits)]
+    _fill_buckets(buckets, ids, seed, digits, scheme)
+    return [(index, bucket) for index, bucket in enumerate(buckets) if bucket]
+
+
+def make_ticket_buckets(id_list, seed, scheme=DEFAULT_SCHEME, processes=None):
+    """Distribute the first tickets of the ids among buckets by the
+    leading digits of their ticket numbers.
+
+    Since ticket numbers are uniform on (0, 1), each bucket holds only
+    a few tickets on average, and listing the buckets in order, each
+    sorted, lists all the tickets in order.  Building the buckets takes
+    one pass, with expected O(1) work per ticket, and a bucket need
+    only be sorted when it is reached (see bucket_tickets), so the
+    first tickets in order are available much sooner than after a full
+    sort.
+
+    Args:
+        id_list (iterable): distinct hashable ids
+        seed (object): the seed
+        scheme (str): the hash scheme (see HASH_SCHEMES)
+        processes (int): if greater than 1, the ids are divided among
+            this many worker processes, each hashing its share and
+            filling buckets of its own, which are then combined
+            (defaults to None, meaning all work is done in the calling
+            process)
+
+    Returns:
+        a list of 10**d lists for some d, where the list at index i
+        holds, unsorted, the tickets whose ticket numbers begin
+        with the d digits of i.
 
     Example:
-        >>> x = Ticket('0.234', 'x', 2)
-        >>> y = Ticket('0.354', 'y', 1)
-        >>> z = Ticket('0.666', 'z', 2)
-        >>> heap = []
-        >>> heapq.heappush(heap, x)
-        >>> heapq.heappush(heap, y)
-        >>> heapq.heappush(heap, z)
-        >>> for ticket in heap:
-        ...    print(ticket)
-        Ticket(ticket_number='0.234', id='x', generation=2)
-        Ticket(ticket_number='0.354', id='y', generation=1)
-        Ticket(ticket_number='0.666', id='z', generation=2)
-        >>> draw_with_replacement(heap)
-        Ticket(ticket_number='0.234', id='x', generation=2)
-        >>> for ticket in heap:
-        ...    print(ticket)
-        Ticket(ticket_number='0.354', id='y', generation=1)
-        Ticket(ticket_number='0.666', id='z', generation=2)
-        Ticket(ticket_number='0.547830802749402616364646686795722512609112766306951592422621788875312684400211', id='x', generation=3)
+        >>> buckets = make_ticket_buckets(range(100), 314159)
+        >>> len(buckets), [trim(ticket.ticket_number, 4)
+        ...                    for ticket in buckets[10]]
+        (100, ['0.1042', '0.1015', '0.1027'])
+        >>> list(bucket_tickets(buckets)) == sorted(
+        ...     make_ticket_heap(range(100), 314159))
+        True
+        >>> make_ticket_buckets([], 314159, processes=2)
+        [[], [], [], [], [], [], [], [], [], []]
     """
 
-    ticket = heapq.heappop(heap)
-    heapq.heappush(heap, next_ticket(ticket))
-    return ticket
+    if not isinstance(id_list, collections.abc.Sequence):
+        id_list = list(id_list)
+    digits = _bucket_digits(len(id_list))
+    buckets = [[] for _ in range(10 ** digits)]
+    if processes is not None and processes > 1 and len(id_list) > 0:
+        import multiprocessing
+        step = -(-len(id_list) // processes)
+        segments = [(list(id_list[i:i + step]), seed, digits, scheme)
+                    for i in range(0, len(id_list), step)]
+        with multiprocessing.Pool(processes) as pool:
+            for filled in pool.map(_bucket_segment, segments):
+                for index, tickets in filled:
+                    buckets[index].extend(tickets)
+    else:
+        _fill_buckets(buckets, id_list, seed, digits, scheme)
+    return buckets
 
 
-def sampler(id_list,
-            seed,
-            with_replacement=False,
-            drop=0,
-            take=float('inf'),
-            output='tuple',
-            digits=9,
-            ):
-    """Return generator for a sample of the given list of ids.
+def bucket_tickets(buckets):
+    """Generate the tickets of buckets (from make_ticket_buckets) in
+    increasing order, sorting each bucket only when it is reached."""
 
-    The sample is determined in a pseudo-random order controlled by
-    the given seed.
+    for bucket in buckets:
+        if bucket:
+            bucket.sort()
+            yield from bucket
 
-    Args:
-        id_list (iterable): a list or iterable for a finite collection
-            of ids.  Each id is typically a string, but may be a tuple
-            or other hashable object.  It is checked that these ids
-            are distinct.
-        seed (object): a python object with a string representation
-        with_replacement (bool): True if and only if sampling is with
-            replacement (defaults to False)
-        drop (int): an integer saying how many of the output sequence to drop
+
+RUN_FILE_MAGIC = b'consistent_sampler ticket run v1\n'
+"""
+Header identifying a ticket run file written by make_ticket_runs.
+"""
+
+_RUN_RECORD = struct.Struct('>32sI')
+
+
+def _is_plain_tuple(x):
+    """Return True if x is a tuple built only of strs, ints and tuples."""
+
+    return type(x) is tuple and all(type(item) in (str, int)
+                                    or _is_plain_tuple(item)
+                                    for item in x)
+
+
+def _encode_id(id):
+    """Return bytes encoding id: a type tag followed by its contents.
+
+    Strings and integers have their own tags; other ids (such as
+    tuples) are written as their repr when ast.literal_eval gives the
+    id back, and otherwise raise ValueError.  Nothing is pickled, so
+    that readers never have to unpickle untrusted data.
+    """
+
+    if type(id) is str:
+        return b's' + id.encode('utf-8')
+    if type(id) is int:
+        return b'i' + str(id).encode('ascii')
+    text = repr(id)
+    if _is_plain_tuple(id):
+        literal = True
+    else:
+        try:
+            literal = ast.literal_eval(text) == id
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            literal = False
+    if literal:
+        return b'r' + text.encode('utf-8')
+    raise ValueError("id {!r} cannot be encoded without pickle"
+                     .format(id))
+
+
+def _decode_id(data):
+    """Return the id encoded as data by _encode_id."""
+
+    tag, body = data[:1], data[1:]
+    if tag == b's':
+        return body.decode('utf-8')
+    if tag == b'i':
+        return int(body)
+    if tag == b'r':
+        return ast.literal_eval(body.decode('utf-8'))
+    raise ValueError("unknown id tag {!r}".format(tag))
+
+
+def _write_ticket_run(path, tickets):
+    """Write a sorted list of first-generation tickets to a run file.
+
+    Each record holds the 256-bit hash value from which the ticket
+    number was made (32 bytes, which determines the '0.ddd...ddd'
+    string) and the length-prefixed encoded id.  Ids are not pickled,
+    so that reading a run file never unpickles it.
+    """
+
+    records = [RUN_FILE_MAGIC]
+    for ticket in tickets:
+        id_bytes = _encode_id(ticket.id)
+        value = int(ticket.ticket_number[:1:-1])
+        records.append(_RUN_RECORD.pack(value.to_bytes(32, 'big'),
+                                        len(id_bytes)))
+        records.append(id_bytes)
+    _write_atomically(path, b''.join(records))
+
+
+def _write_atomically(path, data):
+    """Write bytes data to path so that a crash leaves either the old
+    file or the complete new one."""
+
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def _read_checkpoint(path, identity):
+    """Return the state saved in checkpoint file path, or None if there
+    is no such file.
+
+    Args:
+        path (str): the checkpoint file
+        identity (dict): what the checkpoint must have been made for
+            (routine, seed hash, scheme, and sizes); a checkpoint made
+            for anything else raises AssertionError rather than being
+            resumed
+    """
+
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    assert state['identity'] == identity,\
+        "checkpoint {} was made for {}, not {}"\
+        .format(path, state['identity'], identity)
+    return state
+
+
+def _write_checkpoint(path, identity, **state):
+    """Save state to checkpoint file path, atomically."""
+
+    state['identity'] = identity
+    _write_atomically(path, json.dumps(state).encode('utf-8'))
+
+
+def _read_ticket_run(path):
+    """Generate the tickets stored in a run file, in order."""
+
+    with open(path, 'rb') as f:
+        assert f.read(len(RUN_FILE_MAGIC)) == RUN_FILE_MAGIC,\
+            "{} is not a ticket run file".format(path)
+        while True:
+            head = f.read(_RUN_RECORD.size)
+            if not head:
+                return
+            key, length = _RUN_RECORD.unpack(head)
+            yield Ticket(_digest_uniform(key),
+                         _decode_id(f.read(length)), 1)
+
+
+def make_ticket_runs(id_list, seed, run_size, directory,
+                     scheme=DEFAULT_SCHEME, checkpoint=None):
+    """Write the first tickets for id_list to sorted run files on disk.
+
+    This is the first half of an external-memory sort of the tickets,
+    for manifests too large to hold all their tickets in memory (as
+    make_ticket_heap does).  The ids are hashed run_size at a time;
+    each batch of tickets is sorted and written to its own file in a
+    compact binary form.
+
+    Args:
+        id_list (iterable): distinct hashable ids, each a str, an int,
+            or a literal that ast.literal_eval reads back (such as a
+            tuple of strings); other ids raise ValueError, as run
+            files are never unpickled
+        seed (object): the seed
+        run_size (int): the number of tickets held in memory at once
+        directory (str): an existing directory for the run files
+        scheme (str): the hash scheme (see HASH_SCHEMES)
+        checkpoint (str): if given, the name of a checkpoint file,
+            rewritten (atomically) after each run file is written
+            with the number of ids done and the runs so far.  If the
+            file exists when make_ticket_runs is called, the work
+            resumes from it: the ids already done are skipped over
+            without hashing.  The result is the same as without a
+            checkpoint, as long as id_list, seed and the other
+            arguments are the same; the checkpoint file is left in
+            place for the caller to remove.
+
+    Returns:
+        a list of the paths of the run files written.
+
+    Example:
+        >>> import tempfile
+        >>> directory = tempfile.TemporaryDirectory()
+        >>> paths = make_ticket_runs(['dog', 'cat', 'fish', 'goat'],
+        ...                          'xy()134!g2n', 3, directory.name)
+        >>> len(paths)
+        2
+        >>> for ticket in merge_ticket_runs(paths):
+        ...     print(ticket.id, trim(ticket.ticket_number))
+        cat 0.248664138
+        dog 0.338860356
+        goat 0.495998420
+        fish 0.746859320
+
+        A build interrupted after a checkpoint resumes where it left
+        off, keeping the runs already written:
+
+        >>> def ids_until_crash():
+        ...     yield from range(6000)
+        ...     raise RuntimeError("crash")
+        >>> runs = os.path.join(directory.name, 'runs')
+        >>> os.mkdir(runs)
+        >>> path = os.path.join(directory.name, 'runs.checkpoint')
+        >>> make_ticket_runs(ids_until_crash(), 1, 1000, runs,
+        ...                  checkpoint=path)
+        Traceback (most recent call last):
+        ...
+        RuntimeError: crash
+        >>> len(os.listdir(runs))
+        4
+        >>> resumed = make_ticket_runs(range(9000), 1, 1000, runs,
+        ...                            checkpoint=path)
+        >>> len(resumed)
+        9
+        >>> list(merge_ticket_runs(resumed)) == sorted(
+        ...     make_ticket_heap(range(9000), 1))
+        True
+        >>> directory.cleanup()
+    """
+
+    assert type(run_size) is int and run_size > 0
+    paths = []
+    offset = 0
+    if checkpoint is not None:
+        identity = {'routine': 'make_ticket_runs', 'run_size': run_size,
+                    'seed_hash': hash_hex(seed, scheme), 'scheme': scheme,
+                    'directory': os.path.abspath(directory)}
+        state = _read_checkpoint(checkpoint, identity)
+        if state is not None:
+            offset = state['offset']
+            paths = state['paths']
+            if state['complete']:
+                return paths
+            id_list = itertools.islice(id_list, offset, None)
+    tickets = _iter_first_tickets(id_list, seed, scheme=scheme)
+    while True:
+        run = sorted(itertools.islice(tickets, run_size))
+        if run:
+            path = os.path.join(directory,
+                                'run{:06d}.tickets'.format(len(paths)))
+            _write_ticket_run(path, run)
+            paths.append(path)
+            offset += len(run)
+        if checkpoint is not None:
+            _write_checkpoint(checkpoint, identity, offset=offset,
+                              paths=paths, complete=not run)
+        if not run:
+            return paths
+
+
+def merge_ticket_runs(paths):
+    """Generate the tickets in run files in order of ticket number.
+
+    This is the second half of the external-memory sort begun by
+    make_ticket_runs; the runs are streamed through a k-way merge.
+
+    Args:
+        paths (list): paths of run files written by make_ticket_runs
+
+    Returns:
+        a generator of Tickets, in sampling order.
+    """
+
+    return heapq.merge(*(_read_ticket_run(path) for path in paths))
+
+
+TICKET_STREAM_MAGIC = b'consistent_sampler ticket stream\n'
+"""
+Header identifying a ticket stream written by TicketStreamWriter.
+"""
+
+TICKET_STREAM_VERSION = 1
+"""
+Version of the ticket stream format written by TicketStreamWriter.
+"""
+
+_STREAM_HEADER = struct.Struct('>BBH')      # version, flags, key width
+_STREAM_COMPRESSED = 0x01
+
+# Ticket keys hold one digit per half-byte, digit d as d+1, padded
+# with zeros; so keys compare as bytes just as the ticket numbers
+# compare as strings.
+_KEY_DIGITS = str.maketrans('0123456789', '123456789a')
+_KEY_HEX = str.maketrans('123456789a', '0123456789')
+
+
+def _ticket_key(ticket_number, key_width=None):
+    """Return the key_width-byte key for ticket_number (or, if key_width
+    is None, the shortest key holding all of its digits)."""
+
+    digits = ticket_number[2:]
+    assert ticket_number[:2] == '0.' and not digits.strip('0123456789'),\
+        "bad ticket number {!r}".format(ticket_number)
+    if key_width is None:
+        key_width = (len(digits) + 1) // 2
+    assert len(digits) <= 2 * key_width,\
+        "ticket number {} has more than {} digits"\
+        .format(ticket_number, 2 * key_width)
+    return bytes.fromhex(digits.translate(_KEY_DIGITS)
+                         .ljust(2 * key_width, '0'))
+
+
+def _key_ticket_number(key):
+    """Return the ticket number whose key is the bytes-like key."""
+
+    return "0." + key.hex().rstrip('0').translate(_KEY_HEX)
+
+
+def _encode_varint(n):
+    """Return the LEB128 encoding of nonnegative integer n."""
+
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _read_varint(f):
+    """Read a LEB128-encoded integer from f; return None at end of file."""
+
+    n = shift = 0
+    while True:
+        byte = f.read(1)
+        if not byte:
+            assert shift == 0, "ticket stream ends inside a record"
+            return None
+        n |= (byte[0] & 0x7f) << shift
+        if byte[0] < 0x80:
+            return n
+        shift += 7
+
+
+class TicketStreamWriter:
+    """Write Tickets to a binary file in the ticket stream format.
+
+    The stream is a compact, versioned alternative to text for
+    shipping sample orders between sites.  After a header (magic
+    bytes, format version, flags, key width, and the length-prefixed
+    name of the hash scheme), each ticket is written as one record:
+        generation: a varint
+        ticket number: its decimal digits, two to a byte, in
+            key_width bytes; or, if key_width is 0, in as many bytes
+            as needed, preceded by their number as a varint
+        id: a varint length, then a type tag and the encoded id
+    Ids are tagged as str, int, or a repr that ast.literal_eval reads
+    back (such as a tuple of strings); other ids are rejected, as
+    readers should not have to unpickle untrusted data.  Ticket
+    numbers are stored exactly, so a stream reads back to the very
+    same Tickets, however many digits they have (ticket numbers gain
+    digits as an id is drawn again and again with replacement).  If
+    compress is True the records are gzip-compressed.
+
+    The writer does not close f; close the writer (or use it in a
+    with statement) before closing f.
+
+    Example:
+        >>> import io
+        >>> f = io.BytesIO()
+        >>> with TicketStreamWriter(f, compress=True) as writer:
+        ...     writer.write_tickets(sampler(['a', 'b', ('c', 1)], 123,
+        ...                                  take=3, output='ticket'))
+        3
+        >>> _ = f.seek(0)
+        >>> for ticket in TicketStreamReader(f):
+        ...     print(ticket)
+        Ticket(ticket_number='0.036737721', id='b', generation=1)
+        Ticket(ticket_number='0.525654727', id=('c', 1), generation=1)
+        Ticket(ticket_number='0.9331314328', id='a', generation=1)
+
+        Untrimmed tickets read back unchanged, and streams from
+        separate sites merge into the combined sample order:
+
+        >>> def shipped(ids):
+        ...     f = io.BytesIO()
+        ...     with TicketStreamWriter(f) as writer:
+        ...         writer.write_tickets(sampler(ids, 123, take=5,
+        ...                                      with_replacement=True,
+        ...                                      output='ticket',
+        ...                                      digits=100))
+        ...     _ = f.seek(0)
+        ...     return TicketStreamReader(f)
+        >>> merged = list(heapq.merge(shipped(['a', 'b']),
+        ...                           shipped([('c', 1), 17])))
+        >>> merged[:5] == list(sampler(['a', 'b', ('c', 1), 17], 123,
+        ...                            take=5, with_replacement=True,
+        ...                            output='ticket', digits=100))
+        True
+        >>> len(merged[0].ticket_number) > 60
+        True
+
+        Long with-replacement streams, whose ticket numbers run to
+        hundreds of digits, read back exactly:
+
+        >>> tickets = list(sampler(['a', 'b', 'c'], 1, take=300,
+        ...                        with_replacement=True, output='ticket',
+        ...                        digits=1000, scheme='sha256-v2'))
+        >>> max(len(ticket.ticket_number) for ticket in tickets) > 100
+        True
+        >>> f = io.BytesIO()
+        >>> with TicketStreamWriter(f, scheme='sha256-v2') as writer:
+        ...     writer.write_tickets(tickets)
+        300
+        >>> _ = f.seek(0)
+        >>> list(TicketStreamReader(f)) == tickets
+        True
+    """
+
+    def __init__(self, f, key_width=0, compress=False,
+                 scheme=DEFAULT_SCHEME):
+        """Write the stream header to binary file f.
+
+        Args:
+            f (file): a binary file opened for writing
+            key_width (int): bytes per ticket number, each holding two
+                digits, or 0 (the default) to store each ticket number
+                in as many bytes as it needs.  A fixed width makes
+                records a little smaller when all ticket numbers are
+                known to be short (such as tickets trimmed to a
+                number of digits); a longer ticket number raises
+                AssertionError.
+            compress (bool): if True, gzip the records
+            scheme (str): the hash scheme the tickets were made with
+        """
+
+        assert type(key_width) is int and 0 <= key_width < 1 << 16
+        _scheme_hash(scheme)
+        self.key_width = key_width
+        self.compress = compress
+        self.scheme = scheme
+        self._file = f
+        scheme_bytes = scheme.encode('ascii')
+        f.write(TICKET_STREAM_MAGIC
+                + _STREAM_HEADER.pack(TICKET_STREAM_VERSION,
+                                      _STREAM_COMPRESSED if compress else 0,
+                                      key_width)
+                + bytes([len(scheme_bytes)]) + scheme_bytes)
+        if compress:
+            self._out = gzip.GzipFile(fileobj=f, mode='wb')
+        else:
+            self._out = f
+
+    def _record(self, ticket):
+        """Return the bytes of the record for ticket."""
+
+        ticket_number, id, generation = ticket
+        assert type(generation) is int and generation >= 0
+        id_bytes = _encode_id(id)
+        if self.key_width:
+            key = _ticket_key(ticket_number, self.key_width)
+        else:
+            key = _encode_varint(len(ticket_number) - 2) \
+                + _ticket_key(ticket_number)
+        return b''.join((
+            _encode_varint(generation),
+            key,
+            _encode_varint(len(id_bytes)),
+            id_bytes))
+
+    def write(self, ticket):
+        """Append one Ticket to the stream."""
+
+        self._out.write(self._record(ticket))
+
+    def write_tickets(self, tickets, chunk_size=4096):
+        """Append all of the given Tickets to the stream.
+
+        Args:
+            tickets (iterable): Tickets, such as from sampler with
+                output='ticket'
+            chunk_size (int): number of records written at once
+
+        Returns:
+            the number of tickets written.
+        """
+
+        count = 0
+        tickets = iter(tickets)
+        while True:
+            chunk = list(itertools.islice(tickets, chunk_size))
+            if not chunk:
+                return count
+            self._out.write(b''.join(map(self._record, chunk)))
+            count += len(chunk)
+
+    def close(self):
+        """Finish the stream, flushing any compressed data to f."""
+
+        if self._out is not self._file:
+            self._out.close()
+        self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TicketStreamReader:
+    """Read the Tickets in a stream written by TicketStreamWriter.
+
+    A reader is an iterable of Tickets in the order they were written,
+    read lazily from f; streams holding sample orders can thus be
+    combined directly with heapq.merge(*readers).  Only str, int and
+    literal ids are decoded; nothing in the stream is unpickled.
+    The hash scheme named in the header is available as the scheme
+    attribute.
+    """
+
+    def __init__(self, f):
+        """Read and check the stream header of binary file f."""
+
+        magic = f.read(len(TICKET_STREAM_MAGIC))
+        assert magic == TICKET_STREAM_MAGIC, "not a ticket stream"
+        version, flags, key_width = \
+            _STREAM_HEADER.unpack(f.read(_STREAM_HEADER.size))
+        assert version == TICKET_STREAM_VERSION,\
+            "unsupported ticket stream version {}".format(version)
+        assert flags & ~_STREAM_COMPRESSED == 0,\
+            "unknown ticket stream flags {:#x}".format(flags)
+        self.scheme = f.read(f.read(1)[0]).decode('ascii')
+        self.key_width = key_width
+        self.compress = bool(flags & _STREAM_COMPRESSED)
+        if self.compress:
+            self._in = gzip.GzipFile(fileobj=f, mode='rb')
+        else:
+            self._in = f
+
+    def __iter__(self):
+        f = self._in
+        key_width = self.key_width
+        while True:
+            generation = _read_varint(f)
+            if generation is None:
+                return
+            width = key_width
+            if not width:
+                digit_count = _read_varint(f)
+                assert digit_count is not None,\
+                    "ticket stream ends inside a record"
+                width = (digit_count + 1) // 2
+            key = f.read(width)
+            id_length = _read_varint(f)
+            id_bytes = f.read(id_length or 0)
+            assert len(key) == width and len(id_bytes) == id_length,\
+                "ticket stream ends inside a record"
+            yield Ticket(_key_ticket_number(key),
+                         _decode_id(id_bytes),
+                         generation)
+
+
+def draw_without_replacement(heap):
+    """Return ticket drawn without replacement from given heap of tickets.
+
+    Args:
+        heap (list): an array of Tickets, arranged into a heap using heapq.
+            Such a heap is also known as a 'priority queue'.
+
+    Returns:
+        the Ticket with the least ticket number in the heap.
+
+    Side-effects:
+        the heap is reduced in size by one, as the drawn ticket is not
+        replaced.
+
+    Example:
+        >>> x = Ticket('0.234', 'x', 2)
+        >>> y = Ticket('0.354', 'y', 1)
+        >>> z = Ticket('0.666', 'z', 2)
+        >>> heap = []
+        >>> heapq.heappush(heap, x)
+        >>> heapq.heappush(heap, y)
+        >>> heapq.heappush(heap, z)
+        >>> for ticket in heap:
+        ...     print(ticket)
+        Ticket(ticket_number='0.234', id='x', generation=2)
+        Ticket(ticket_number='0.354', id='y', generation=1)
+        Ticket(ticket_number='0.666', id='z', generation=2)
+        >>> draw_without_replacement(heap)
+        Ticket(ticket_number='0.234', id='x', generation=2)
+    """
+
+    ticket = heapq.heappop(heap)
+    return ticket
+
+
+def draw_with_replacement(heap):
+    """Return ticket drawn with replacement from given heap of tickets.
+
+    Args:
+        heap (list): an array of Tickets, arranged into a heap using heapq.
+            Such a heap is also known as a 'priority queue'.
+
+    Returns:
+        the Ticket with the least ticket number in the heap.
+
+    Side-effects:
+        the heap maintains its size, as the drawn ticket is replaced
+            in the heap by the next ticket for that id.
+
+    Example:
+        >>> x = Ticket('0.234', 'x', 2)
+        >>> y = Ticket('0.354', 'y', 1)
+        >>> z = Ticket('0.666', 'z', 2)
+        >>> heap = []
+        >>> heapq.heappush(heap, x)
+        >>> heapq.heappush(heap, y)
+        >>> heapq.heappush(heap, z)
+        >>> for ticket in heap:
+        ...    print(ticket)
+        Ticket(ticket_number='0.234', id='x', generation=2)
+        Ticket(ticket_number='0.354', id='y', generation=1)
+        Ticket(ticket_number='0.666', id='z', generation=2)
+        >>> draw_with_replacement(heap)
+        Ticket(ticket_number='0.234', id='x', generation=2)
+        >>> for ticket in heap:
+        ...    print(ticket)
+        Ticket(ticket_number='0.354', id='y', generation=1)
+        Ticket(ticket_number='0.666', id='z', generation=2)
+        Ticket(ticket_number='0.547830802749402616364646686795722512609112766306951592422621788875312684400211', id='x', generation=3)
+    """
+
+    ticket = heapq.heappop(heap)
+    heapq.heappush(heap, next_ticket(ticket))
+    return ticket
+
+
+def sampler(id_list,
+            seed,
+            with_replacement=False,
+            drop=0,
+            take=float('inf'),
+            output='tuple',
+            digits=9,
+            processes=None,
+            max_tickets_in_memory=None,
+            batch_size=None,
+            scheme=DEFAULT_SCHEME,
+            engine='auto',
+            explain=False,
+            ):
+    """Return generator for a sample of the given list of ids.
+
+    The sample is determined in a pseudo-random order controlled by
+    the given seed.
+
+    Args:
+        id_list (iterable): a list or iterable for a finite collection
+            of ids.  Each id is typically a string, but may be a tuple
+            or other hashable object.  It is checked that these ids
+            are distinct.  A range or a BatchManifest may be given to
+            describe the ids compactly; its ids are then generated as
+            they are hashed, and (if take is finite) only those that
+            may be sampled are kept.
+        seed (object): a python object with a string representation
+        with_replacement (bool): True if and only if sampling is with
+            replacement (defaults to False)
+        drop (int): an integer saying how many of the output sequence to drop
             (defaults to 0)
         take (int): an integer giving an upper bound on the number of
             elements of the output sequence to take, after the drops.
@@ -524,6 +2011,58 @@ def sampler(id_list,
             significant digits to give after the initial segment
             of 9s.)
             (default is 9)
+        processes (int): the number of worker processes sampler may
+            use.  With more than one, the engine planner may divide
+            the hashing among worker processes: with replacement,
+            each extending the ticket chains of its share of the
+            ids, which pays off when drop+take is much larger than
+            the number of ids; or, with the bucket engine, each
+            bucketing its share.  The planner uses no more processes
+            than there are CPUs, but an engine named explicitly
+            uses as many as are given.
+            (defaults to None, meaning all work is done in the
+            calling process)
+        max_tickets_in_memory (int): if given, and more tickets than
+            this would otherwise be held in memory, the first tickets
+            are sorted externally in temporary files of at most this
+            many tickets each (see make_ticket_runs, which limits the
+            kinds of ids), and then merged.
+            (defaults to None, meaning no limit)
+        batch_size (int): if given, the generator yields lists of
+            (up to) batch_size consecutive outputs rather than single
+            outputs, formatting each list in bulk.  This saves
+            per-item overhead when many items are wanted.
+            (defaults to None)
+        scheme (str): the hash scheme for ticket numbers, one of the
+            names in HASH_SCHEMES.  A sample can be reproduced only
+            with the scheme it was drawn with.
+            (defaults to DEFAULT_SCHEME, 'sha256-v1')
+        engine (str): how tickets are put in order:
+            'heap': with a heap, of only the drop+take tickets with
+                smallest first ticket numbers when that is finite;
+            'bucket': by bucketing all the first tickets on the
+                leading digits of their ticket numbers and sorting
+                each bucket only when it is reached (see
+                make_ticket_buckets), possibly in worker processes;
+            'parallel': with replacement only, by extending ticket
+                chains in worker processes and merging them;
+            'external': by sorting externally, in temporary files of
+                at most max_tickets_in_memory tickets each;
+            'auto': as chosen by the engine planner, which estimates
+                the time each engine would take for the number of
+                ids, drop+take, the replacement mode and the worker
+                processes allowed, using the unit costs in
+                ENGINE_CALIBRATION, and picks the quickest.  (The
+                external engine is chosen whenever
+                max_tickets_in_memory is given and drop+take exceeds
+                it.)
+            All engines give exactly the same sample.
+            (defaults to 'auto')
+        explain (bool): if True, sampler samples nothing and returns
+            instead the EnginePlan it would use, giving the engine,
+            the number of worker processes and the estimated time of
+            each engine considered.
+            (defaults to False)
 
     Outputs:
         a generator for the sample.
@@ -564,40 +2103,1995 @@ def sampler(id_list,
         ('0.9098039269', 'ab-1', 1)
         ('0.9231549043', 'ab-2', 1)
 
+        >>> for batch in sampler(['ab-1', 'ab-2', 'cd-1', 'ef-3'],
+        ...                      seed=314159, output='id', batch_size=3):
+        ...     print(batch)
+        ['cd-1', 'ef-3', 'ab-1']
+        ['ab-2']
+
+        >>> plan = sampler(range(10 ** 6), 314159, take=10, explain=True)
+        >>> plan.engine, plan.processes
+        ('heap', 1)
+        >>> sampler(range(10 ** 6), 314159, explain=True).engine
+        'bucket'
+
         For additional examples see demo_consistent_sampler.py
         or USAGE_EXAMPLES.md
     """
 
-    assert len(id_list) == len(set(id_list)),\
-        "Input id_list to sampler contains duplicate ids: {}"\
-        .format(duplicates(id_list))
+    _assert_distinct(id_list, 'sampler')
     assert type(with_replacement) is bool
     output = output.lower()
     assert output in {'id', 'tuple', 'ticket'}
     assert type(digits) is int
-    
-    heap = make_ticket_heap(id_list, seed)
+    _scheme_hash(scheme)
+    assert batch_size is None or (type(batch_size) is int and batch_size > 0)
+
+    plan = _plan_engine(len(id_list), with_replacement, drop + take,
+                        processes, max_tickets_in_memory, engine, scheme)
+    if explain:
+        return plan
+    return _sampler_outputs(id_list, seed, with_replacement, drop, take,
+                            output, digits, max_tickets_in_memory,
+                            batch_size, scheme, plan)
+
+
+def _sampler_outputs(id_list, seed, with_replacement, drop, take, output,
+                     digits, max_tickets_in_memory, batch_size, scheme,
+                     plan):
+    """Generate what sampler yields, with the engine of the given plan.
+
+    This is a separate generator so that sampler can check its
+    arguments, and return a plan, when called.
+    """
+
+    tickets = _ticket_stream(id_list, seed, with_replacement, drop + take,
+                             plan.processes, max_tickets_in_memory, scheme,
+                             plan.engine)
+    if batch_size is not None:
+        stop = int(drop + take) if take < float('inf') else None
+        tickets = itertools.islice(tickets, drop, stop)
+        while True:
+            batch = list(itertools.islice(tickets, batch_size))
+            if not batch:
+                return
+            yield _output_batch(batch, output, digits)
     count = 0
-    while len(heap) > 0:
-        ticket = draw_without_replacement(heap)
-        if with_replacement:
-            heapq.heappush(heap, next_ticket(ticket))
+    for ticket in tickets:
         count += 1
         if drop < count <= drop + take:
-            ticket_list = list(ticket)
-            ticket_list[0] = trim(ticket_list[0], digits)
-            if output == 'id':
-                yield ticket.id
-            elif output == 'tuple':
-                yield tuple(ticket_list)
-            else:
-                yield Ticket(ticket_number=ticket_list[0],
-                             id=ticket_list[1],
-                             generation=ticket_list[2])
-        elif count > drop+take:
+            yield _output_form(ticket, output, digits)
+        if count >= drop + take:
             return
 
 
+# Seconds per unit of work on a reference machine (with the compiled
+# ticket kernel), used by the engine planner to estimate how long each
+# engine would take.  Regenerate with
+#     python benchmark_consistent_sampler.py --calibrate
+# or, at run time, ENGINE_CALIBRATION.update(calibrate_engines()).
+ENGINE_CALIBRATION = {
+    'first_ticket': 7.7e-07,   # hashing one id to its first ticket
+    'select': 3.3e-07,         # offering a ticket to a bounded selection
+    'heap_push': 7.4e-07,      # pushing a ticket onto a full heap
+    'heap_pop': 8.1e-08,       # one level of a heap pop (times log2 size)
+    'bucket': 1.56e-06,        # putting a ticket in its bucket
+    'bucket_sort': 1.9e-07,    # sorting a bucket, per ticket
+    'next_ticket': 3.7e-06,    # computing a next-generation ticket
+    'next_ticket_v2': 9.0e-05,  # the same, with a random-access scheme
+    'transfer': 2.9e-06,       # passing a ticket between processes
+    'process_start': 5.7e-03,  # starting a worker process
+}
+
+
+ENGINES = ('heap', 'bucket', 'parallel', 'external')
+
+
+EnginePlan = collections.namedtuple("EnginePlan",
+                                    ['engine',
+                                     'processes',
+                                     'estimates'])
+EnginePlan.__doc__ = """The engine sampler uses, as chosen by its planner.
+
+engine is one of ENGINES; processes is the number of processes it
+uses (1 meaning only the calling process); estimates maps each
+(engine, processes) pair considered to its estimated time in seconds
+(empty if the engine was not chosen by estimate).
+"""
+
+
+def _engine_estimates(n, with_replacement, k, cores, calibration,
+                      scheme=DEFAULT_SCHEME):
+    """Return a dict mapping (engine, processes) pairs to estimated
+    seconds, for sampling drop+take=k of n ids."""
+
+    c = calibration
+    next_cost = c['next_ticket_v2' if scheme in _RANDOM_ACCESS_SCHEMES
+                  else 'next_ticket']
+    m = min(k, n) if not with_replacement else k
+    if m == float('inf'):
+        m = n          # the first n draws, as a yardstick
+    log_n = math.log2(n + 1)
+    chains = m * next_cost if with_replacement else 0.0
+    if k < n:
+        heap = (n * (c['first_ticket'] + c['select'])
+                + m * math.log2(m + 1) * c['heap_pop'])
+    else:
+        heap = (n * (c['first_ticket'] + c['heap_push'])
+                + m * log_n * c['heap_pop'])
+    estimates = {('heap', 1): heap + chains}
+    if with_replacement:
+        merge = m * math.log2(min(m, n) + 1) * c['heap_pop']
+    else:
+        merge = 0.0
+    for p in sorted({1, cores}):
+        if p == 1:
+            workers = 0.0
+        else:
+            workers = p * c['process_start'] + n * c['transfer']
+        estimates[('bucket', p)] = (
+            n * (c['first_ticket'] / p + c['bucket'])
+            + m * c['bucket_sort'] + merge + chains + workers)
+    if with_replacement and cores > 1:
+        estimates[('parallel', cores)] = (
+            cores * c['process_start'] + (n + m) * c['transfer']
+            + (n * c['first_ticket'] + chains) / cores
+            + m * math.log2(cores) * c['heap_pop'])
+    return estimates
+
+
+def _plan_engine(n, with_replacement, k, processes=None,
+                 max_tickets_in_memory=None, engine='auto',
+                 scheme=DEFAULT_SCHEME):
+    """Return the EnginePlan for sampling drop+take=k of n ids (n may
+    be None if not known), with the given sampler arguments."""
+
+    assert engine == 'auto' or engine in ENGINES,\
+        "unknown sampler engine {!r}".format(engine)
+    assert processes is None or (type(processes) is int and processes > 0)
+    if engine != 'auto':
+        assert engine != 'parallel' or (with_replacement and
+                                        processes is not None and
+                                        processes > 1),\
+            "the parallel engine needs with_replacement and processes > 1"
+        assert engine != 'external' or max_tickets_in_memory is not None,\
+            "the external engine needs max_tickets_in_memory"
+        return EnginePlan(engine, processes or 1, {})
+    if max_tickets_in_memory is not None and k > max_tickets_in_memory:
+        return EnginePlan('external', 1, {})
+    if not n:
+        return EnginePlan('heap', 1, {})
+    cores = min(processes or 1, os.cpu_count() or 1)
+    estimates = _engine_estimates(n, with_replacement, k, cores,
+                                  ENGINE_CALIBRATION, scheme)
+    engine, processes = min(estimates, key=estimates.get)
+    return EnginePlan(engine, processes, estimates)
+
+
+def _ticket_stream(id_list,
+                   seed,
+                   with_replacement,
+                   k,
+                   processes=None,
+                   max_tickets_in_memory=None,
+                   scheme=DEFAULT_SCHEME,
+                   engine='auto',
+                   ):
+    """Return generator of full-precision tickets in sampling order.
+
+    Args:
+        id_list, seed, with_replacement, processes,
+        max_tickets_in_memory, scheme, engine: as for sampler
+        k (int or float): the number of tickets that will be wanted,
+            that is, drop+take (may be infinite)
+
+    Returns:
+        a generator of Tickets that is correct for at least its first
+        k tickets.
+    """
+
+    if engine == 'auto':
+        n = len(id_list) if isinstance(id_list, collections.abc.Sized) \
+            else None
+        engine, processes, _ = _plan_engine(n, with_replacement, k,
+                                            processes, max_tickets_in_memory,
+                                            scheme=scheme)
+    if engine == 'bucket':
+        return _bucket_ticket_stream(id_list, seed, with_replacement,
+                                     processes, scheme)
+    if engine == 'parallel':
+        return _parallel_replacement_tickets(id_list, seed, k, processes,
+                                             scheme)
+    if engine == 'external':
+        return _external_tickets(id_list, seed, with_replacement,
+                                 max_tickets_in_memory, scheme)
+    if k < float('inf'):
+        # Only the k tickets with smallest first-generation ticket
+        # numbers can be drawn in the first k draws, with or without
+        # replacement, since later generations of an id have larger
+        # ticket numbers.  So that is all we keep.
+        heap = make_ticket_heap(id_list, seed, limit=int(k), scheme=scheme)
+    else:
+        heap = make_ticket_heap(id_list, seed, scheme=scheme)
+    return _heap_tickets(heap, with_replacement, scheme)
+
+
+def _heap_tickets(heap, with_replacement, scheme=DEFAULT_SCHEME,
+                  first_numbers=None):
+    """Generate tickets in sampling order by drawing from heap.
+
+    When sampling with replacement, the next ticket for a drawn id is
+    computed only when the following draw is requested, so the final
+    draw of a run costs no hashing.  The drawn ticket is replaced at
+    the top of the heap in one sift (heapreplace) rather than popped
+    and pushed.
+    """
+
+    if first_numbers is None:
+        first_numbers = {}
+    while len(heap) > 0:
+        ticket = heap[0]
+        yield ticket
+        if with_replacement:
+            heapq.heapreplace(heap, _next_chain_ticket(ticket, scheme,
+                                                       first_numbers))
+        else:
+            heapq.heappop(heap)
+
+
+def _replacement_cutoff(chain_length):
+    """Return ticket number below which an id expects chain_length tickets.
+
+    With replacement, the values -ln(1-TktNo(id, g)) for g = 1, 2, ...
+    are the points of a rate-one Poisson process, since each ticket is
+    uniform on (previous ticket, 1).  So an id is expected to have
+    chain_length tickets below 1-exp(-chain_length).
+
+    Args:
+        chain_length (float): the desired expected number of tickets
+
+    Returns:
+        the cutoff 1-exp(-chain_length) as a string '0.ddd...ddd',
+        with enough digits to be accurate past its leading 9s.
+    """
+
+    with decimal.localcontext() as context:
+        context.prec = int(chain_length / 2.302585092994046) + 30
+        cutoff = 1 - (-decimal.Decimal(chain_length)).exp()
+        return format(cutoff, 'f')
+
+
+def _chain_segment(segment):
+    """Return the tickets of a group of ids that fall below a cutoff.
+
+    Args:
+        segment (tuple): (ids, seed, starts, cutoff, scheme,
+            first_numbers), packed in one argument for use with
+            multiprocessing.Pool.map.
+            If starts is None, the chains start at the first tickets
+            of ids; otherwise starts is a list of tickets to start from
+            (and ids is ignored, so may be None).  first_numbers is as for
+            _next_chain_ticket.
+
+    Returns:
+        a triple (below, frontier, first_numbers), where below is the
+        sorted list of all chain tickets with ticket number less than
+        cutoff, frontier gives for each chain its first ticket at or
+        above the cutoff, and first_numbers is updated.
+    """
+
+    ids, seed, starts, cutoff, scheme, first_numbers = segment
+    if starts is None:
+        starts = _iter_first_tickets(ids, seed, scheme=scheme)
+    below = []
+    frontier = []
+    for ticket in starts:
+        while ticket.ticket_number < cutoff:
+            below.append(ticket)
+            ticket = _next_chain_ticket(ticket, scheme, first_numbers)
+        frontier.append(ticket)
+    below.sort()
+    return below, frontier, first_numbers
+
+
+def _parallel_replacement_tickets(id_list, seed, k, processes,
+                                  scheme=DEFAULT_SCHEME):
+    """Generate tickets in sampling order with replacement, in parallel.
+
+    Each id's chain of tickets TktNo(id, 1), TktNo(id, 2), ... depends
+    only on the id and seed.  So the ids are divided among worker
+    processes, which generate each chain up to a common cutoff chosen
+    so that about k tickets (with some margin) fall below it; the sorted
+    chain pieces are then merged.  If more tickets are wanted, the
+    cutoff is raised and the chains extended from where they stopped.
+
+    Args:
+        id_list (iterable): distinct ids
+        seed (object): the seed
+        k (int or float): the number of tickets expected to be wanted
+            (may be infinite)
+        processes (int): the number of worker processes
+        scheme (str): the hash scheme
+
+    Returns:
+        a generator of Tickets, in the same order as with the heap.
+
+    Example:
+        >>> ids = ['A-{}'.format(i) for i in range(50)]
+        >>> list(sampler(ids, 314159, with_replacement=True, take=400,
+        ...              engine='parallel', processes=2)) == list(
+        ...     sampler(ids, 314159, with_replacement=True, take=400,
+        ...             engine='heap'))
+        True
+
+        Drawing far more tickets than k raises the cutoff in further
+        rounds, with the same result:
+
+        >>> tickets = _parallel_replacement_tickets(ids, 314159, 10, 2)
+        >>> list(itertools.islice(tickets, 400)) == list(
+        ...     sampler(ids, 314159, with_replacement=True, take=400,
+        ...             output='ticket', digits=1000))
+        True
+    """
+
+    import multiprocessing
+    ids = list(id_list)
+    n = len(ids)
+    if n == 0:
+        return
+    groups = [ids[i::processes] for i in range(processes)]
+    produced = 0
+    chain_length = 0.0
+    starts = [None] * processes
+    first_numbers = [{} for _ in range(processes)]
+    with multiprocessing.Pool(processes) as pool:
+        while True:
+            wanted = k - produced if k < float('inf') else max(produced, n)
+            wanted = max(wanted, 1)
+            chain_length += (wanted + 4 * wanted ** 0.5 + 1) / n
+            cutoff = _replacement_cutoff(chain_length)
+            results = pool.map(_chain_segment,
+                               [(group, seed, start, cutoff, scheme, firsts)
+                                for group, start, firsts
+                                in zip(groups, starts, first_numbers)])
+            starts = [frontier for _, frontier, _ in results]
+            groups = [None] * processes     # not needed once started
+            first_numbers = [firsts for _, _, firsts in results]
+            for ticket in heapq.merge(*(below for below, _, _ in results)):
+                produced += 1
+                yield ticket
+
+
+def _external_tickets(id_list, seed, with_replacement, run_size,
+                      scheme=DEFAULT_SCHEME):
+    """Generate tickets in sampling order using an external sort.
+
+    The first tickets are written to sorted runs in a temporary
+    directory and merged.  With replacement, the merged stream of first
+    tickets is itself merged with a heap holding the next tickets of
+    the ids drawn so far, which is all that needs to be in memory.
+
+    Example:
+        sampler uses this engine when drop+take is more than
+        max_tickets_in_memory; the sample is the same as with the heap:
+
+        >>> ids = ['A-{}'.format(i) for i in range(100)]
+        >>> for with_replacement in (False, True):
+        ...     external = sampler(ids, 314159, with_replacement, drop=20,
+        ...                        take=60, max_tickets_in_memory=30)
+        ...     heap = sampler(ids, 314159, with_replacement, drop=20,
+        ...                    take=60, engine='heap')
+        ...     print(sampler(ids, 314159, with_replacement, drop=20,
+        ...                   take=60, max_tickets_in_memory=30,
+        ...                   explain=True).engine,
+        ...           list(external) == list(heap))
+        external True
+        external True
+        >>> list(sampler(ids, 314159, True, drop=150, take=100,
+        ...              max_tickets_in_memory=30)) == list(
+        ...     sampler(ids, 314159, True, drop=150, take=100, engine='heap'))
+        True
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_ticket_runs(id_list, seed, run_size, directory, scheme)
+        first_tickets = merge_ticket_runs(paths)
+        if not with_replacement:
+            yield from first_tickets
+            return
+        yield from _replacement_merge(first_tickets, scheme)
+
+
+def _replacement_merge(first_tickets, scheme=DEFAULT_SCHEME):
+    """Generate tickets in sampling order with replacement, given the
+    first tickets of all the ids in increasing order.
+
+    The first tickets are merged with a heap holding the next tickets
+    of the ids drawn so far, which is all that needs to be in memory.
+    """
+
+    heap = []
+    first_numbers = {}
+    for ticket in first_tickets:
+        while heap and heap[0] < ticket:
+            drawn = heap[0]
+            yield drawn
+            heapq.heapreplace(heap, _next_chain_ticket(drawn, scheme,
+                                                       first_numbers))
+        yield ticket
+        heapq.heappush(heap, _next_chain_ticket(ticket, scheme,
+                                                first_numbers))
+    yield from _heap_tickets(heap, True, scheme, first_numbers)
+
+
+def _bucket_ticket_stream(id_list, seed, with_replacement, processes=None,
+                          scheme=DEFAULT_SCHEME):
+    """Generate tickets in sampling order using the bucket engine (see
+    make_ticket_buckets); the order is the same as with the heap."""
+
+    first_tickets = bucket_tickets(make_ticket_buckets(id_list, seed, scheme,
+                                                       processes))
+    if with_replacement:
+        return _replacement_merge(first_tickets, scheme)
+    return first_tickets
+
+
+def _output_form(ticket, output, digits):
+    """Return ticket in the form sampler yields for given output and digits.
+    """
+
+    ticket_list = list(ticket)
+    ticket_list[0] = trim(ticket_list[0], digits)
+    if output == 'id':
+        return ticket.id
+    elif output == 'tuple':
+        return tuple(ticket_list)
+    else:
+        return Ticket(ticket_number=ticket_list[0],
+                      id=ticket_list[1],
+                      generation=ticket_list[2])
+
+
+def _trimmed_numbers(tickets, digits):
+    """Return the list of trim(ticket.ticket_number, digits) for tickets."""
+
+    numbers = []
+    for ticket in tickets:
+        number = ticket.ticket_number
+        first_non_9_position = len(number) - len(number[2:].lstrip('9'))
+        numbers.append(number[:first_non_9_position + digits])
+    return numbers
+
+
+def _output_batch(tickets, output, digits):
+    """Return list of _output_form(ticket, output, digits) for tickets.
+
+    Trimming is done for the whole list at once, relying on ticket
+    numbers consisting of decimal digits: the initial segment of 9s is
+    found with lstrip rather than by scanning character by character.
+    """
+
+    if output == 'id':
+        return [ticket.id for ticket in tickets]
+    numbers = _trimmed_numbers(tickets, digits)
+    ids = [ticket.id for ticket in tickets]
+    generations = [ticket.generation for ticket in tickets]
+    if output == 'tuple':
+        return list(zip(numbers, ids, generations))
+    return list(map(Ticket, numbers, ids, generations))
+
+
+# State installed in each worker process by _multi_seed_init.
+_multi_seed_state = {}
+
+
+def _multi_seed_init(id_list, encoded_ids, options):
+    """Install the shared inputs for multi_seed_sampler worker processes."""
+
+    _multi_seed_state['id_list'] = id_list
+    _multi_seed_state['encoded_ids'] = encoded_ids
+    _multi_seed_state['options'] = options
+
+
+def _multi_seed_worker_sample(seed):
+    """Return the sample for one seed, in a worker process, using the
+    inputs installed there by _multi_seed_init."""
+
+    return _multi_seed_sample(_multi_seed_state['id_list'],
+                              _multi_seed_state['encoded_ids'],
+                              _multi_seed_state['options'],
+                              seed)
+
+
+def _multi_seed_sample(id_list, encoded_ids, options, seed):
+    """Return the sample for one seed of multi_seed_sampler."""
+
+    with_replacement, drop, take, output, digits, scheme = options
+    if encoded_ids is None:
+        fractions = first_fractions(id_list, seed, scheme=scheme)
+    else:
+        fractions = _encoded_first_fractions(
+            encoded_ids, hash_hex(seed, scheme), scheme)
+    if output == 'index':
+        tickets = [Ticket(f, i, 1) for i, f in enumerate(fractions)]
+    else:
+        tickets = [Ticket(f, id, 1) for f, id in zip(fractions, id_list)]
+
+    k = drop + take
+    if k < float('inf'):
+        k = int(k)          # take may be given as a float
+    if k < len(tickets):
+        tickets = heapq.nsmallest(k, tickets)
+    else:
+        tickets.sort()
+    if with_replacement:
+        drawn = list(itertools.islice(_heap_tickets(tickets, True, scheme),
+                                      k))
+    else:
+        drawn = tickets
+    drawn = drawn[drop:]
+
+    if output == 'index':
+        return array.array('q', [ticket.id for ticket in drawn])
+    return _output_batch(drawn, output, digits)
+
+
+def multi_seed_sampler(id_list,
+                       seeds,
+                       take,
+                       with_replacement=False,
+                       drop=0,
+                       output='tuple',
+                       digits=9,
+                       processes=None,
+                       scheme=DEFAULT_SCHEME,
+                       ):
+    """Return samples of the same id_list for each of several seeds.
+
+    Equivalent to
+        [list(sampler(id_list, seed, with_replacement, drop, take,
+                      output, digits, scheme=scheme)) for seed in seeds]
+    but validates id_list and encodes the ids once for all seeds, and
+    selects each seed's sample from its first tickets in one pass.
+    This suits simulation studies that rerun the sampler many times.
+
+    Args:
+        id_list (iterable): a finite collection of distinct ids,
+            as for sampler
+        seeds (iterable): the seeds to use
+        take, with_replacement, drop, digits, scheme: as for sampler.
+            If with_replacement is True, take must be finite.
+        output (str): one of {'id', 'tuple', 'ticket', 'index'}.
+            The first three are as for sampler; 'index' gives the
+            sample compactly as an array('q') of positions in id_list.
+        processes (int): if given, the seeds are divided among this
+            many worker processes; by default all work is done in
+            the calling process.
+
+    Returns:
+        a list with one sample per seed, in the order of seeds.
+
+    Example:
+        >>> for sample in multi_seed_sampler(['ab-1', 'ab-2', 'cd-1', 'ef-3'],
+        ...                                  [314159, 271828], take=2,
+        ...                                  output='id'):
+        ...     print(sample)
+        ['cd-1', 'ef-3']
+        ['ef-3', 'ab-1']
+        >>> multi_seed_sampler(['ab-1', 'ab-2', 'cd-1', 'ef-3'], [314159],
+        ...                    take=2, output='index')
+        [array('q', [2, 3])]
+    """
+
+    id_list = list(id_list)
+    assert len(id_list) == len(set(id_list)),\
+        "Input id_list to multi_seed_sampler contains duplicate ids: {}"\
+        .format(duplicates(id_list))
+    assert type(with_replacement) is bool
+    assert not with_replacement or take < float('inf'),\
+        "multi_seed_sampler needs a finite take when sampling with replacement"
+    output = output.lower()
+    assert output in {'id', 'tuple', 'ticket', 'index'}
+    assert type(digits) is int
+    _scheme_hash(scheme)
+
+    encoded_ids = None
+    if _ticket_kernel is None or scheme not in _KERNEL_SCHEMES:
+        encoded_ids = [str(id).encode('utf-8') for id in id_list]
+    options = (with_replacement, drop, take, output, digits, scheme)
+    if processes is None:
+        return [_multi_seed_sample(id_list, encoded_ids, options, seed)
+                for seed in seeds]
+
+    import multiprocessing
+    with multiprocessing.Pool(processes,
+                              initializer=_multi_seed_init,
+                              initargs=(id_list, encoded_ids, options)) as pool:
+        return pool.map(_multi_seed_worker_sample, seeds)
+
+
+def multi_sampler(contests,
+                  seed,
+                  takes,
+                  with_replacement=False,
+                  output='tuple',
+                  digits=9,
+                  scheme=DEFAULT_SCHEME,
+                  ):
+    """Return samples for several collections of ids sharing one seed.
+
+    Equivalent to
+        {name: list(sampler(ids, seed, with_replacement,
+                            take=takes[name], output=output,
+                            digits=digits, scheme=scheme))
+         for name, ids in contests.items()}
+    but when the collections overlap (as when each contest is a subset
+    of a county's ballots), each distinct id is hashed only once: the
+    ticket of an id is the same in every collection containing it.
+    Each collection then keeps only its takes[name] best tickets.
+
+    Args:
+        contests (dict): maps each collection name to its ids
+        seed (object): the seed, shared by all collections
+        takes (int or dict): the sample size for every collection, or
+            a dict giving the sample size for each name.  Must be
+            finite if with_replacement is True.
+        with_replacement, output, digits, scheme: as for sampler
+
+    Returns:
+        a dict mapping each name to the list of its sample.
+
+    Example:
+        >>> samples = multi_sampler({'all': ['A-1', 'A-2', 'A-3',
+        ...                                  'B-1', 'B-2', 'B-3'],
+        ...                          'B': ['B-1', 'B-2', 'B-3']},
+        ...                         seed=314159, takes={'all': 3, 'B': 2},
+        ...                         output='id')
+        >>> samples['all'], samples['B']
+        (['B-2', 'B-3', 'A-3'], ['B-2', 'B-3'])
+    """
+
+    assert type(with_replacement) is bool
+    output = output.lower()
+    assert output in {'id', 'tuple', 'ticket'}
+    assert type(digits) is int
+    if not isinstance(takes, dict):
+        takes = dict.fromkeys(contests, takes)
+    for name, ids in contests.items():
+        _assert_distinct(ids, 'multi_sampler')
+        assert not with_replacement or takes[name] < float('inf'),\
+            "multi_sampler needs finite takes when sampling with replacement"
+
+    # Hash each distinct id once, in bulk.
+    distinct = list({id: None for ids in contests.values() for id in ids})
+    fraction = dict(zip(distinct,
+                        first_fractions(distinct, seed, scheme=scheme)))
+    del distinct
+
+    samples = {}
+    for name, ids in contests.items():
+        take = takes[name]
+        tickets = (Ticket(fraction[id], id, 1) for id in ids)
+        if take < float('inf'):
+            heap = heapq.nsmallest(int(take), tickets)
+            drawn = itertools.islice(
+                _heap_tickets(heap, with_replacement, scheme), int(take))
+        else:
+            drawn = sorted(tickets)
+        samples[name] = _output_batch(list(drawn), output, digits)
+    return samples
+
+
+def tally_sampler(id_list,
+                  seed,
+                  take,
+                  with_replacement=True,
+                  drop=0,
+                  scheme=DEFAULT_SCHEME,
+                  ):
+    """Return how many times each id is drawn, and its last ticket.
+
+    Equivalent to counting the ids in
+        sampler(id_list, seed, with_replacement, drop, take, output='id',
+                scheme=scheme)
+    but without building an output item per draw, which matters when
+    take is large and only the multiplicities are needed (as in
+    ballot-polling audits).
+
+    Args:
+        id_list, seed, with_replacement, drop, scheme: as for sampler
+        take (int): the number of draws to tally, after the drops
+            (must be finite)
+
+    Returns:
+        a pair (counts, last_tickets) of dicts:
+            counts maps each id drawn in the tallied draws to the
+                number of times it was drawn there;
+            last_tickets maps each id drawn in the first drop+take
+                draws to the (full precision) Ticket of its last draw,
+                whose generation is the number of times it was drawn.
+        The run may be extended: the next ticket for an id in
+        last_tickets is next_ticket(last_tickets[id], scheme), and any
+        other id still has its first_ticket.  (With a random-access
+        scheme such as 'sha256-v2', next_ticket also needs
+        first_number=first_ticket(id, seed, scheme=scheme).ticket_number.)
+
+    Example:
+        >>> counts, last_tickets = tally_sampler(
+        ...     ['a1', 'b2', 'c3', 'd4', 'e5', 'f6'], seed=19283746, take=10)
+        >>> sorted(counts.items())
+        [('a1', 2), ('b2', 4), ('c3', 2), ('e5', 1), ('f6', 1)]
+        >>> trim(last_tickets['b2'].ticket_number), last_tickets['b2'].generation
+        ('0.816686725', 4)
+    """
+
+    assert type(with_replacement) is bool
+    assert take < float('inf'), "tally_sampler needs a finite take"
+    _assert_distinct(id_list, 'tally_sampler')
+
+    k = int(drop + take)
+    heap = make_ticket_heap(id_list, seed, limit=k, scheme=scheme)
+    first_numbers = {}
+    counts = {}
+    last_tickets = {}
+    for count in range(k):
+        if not heap:
+            break
+        ticket = heap[0]
+        id = ticket.id
+        last_tickets[id] = ticket
+        if count >= drop:
+            counts[id] = counts.get(id, 0) + 1
+        if count + 1 == k:
+            break
+        if with_replacement:
+            heapq.heapreplace(heap, _next_chain_ticket(ticket, scheme,
+                                                       first_numbers))
+        else:
+            heapq.heappop(heap)
+    return counts, last_tickets
+
+
+class _Descending:
+    """Wraps a Ticket so that heapq's min-heap keeps the largest first."""
+
+    __slots__ = ('ticket',)
+
+    def __init__(self, ticket):
+        self.ticket = ticket
+
+    def __lt__(self, other):
+        return other.ticket < self.ticket
+
+
+class StreamingSample:
+    """The first k draws of a sample of a collection that keeps growing.
+
+    Ids are added one at a time (or in batches) as they arrive, for
+    example as ballots are scanned during a canvass.  Each id's first
+    ticket is computed on arrival, and only the k smallest tickets are
+    kept, in a max-heap, so memory is O(k) however many ids arrive and
+    an add costs O(log k).  At any moment, sample() gives what
+    sampler(all_ids_so_far, seed, take=k) would yield, with or without
+    replacement, since only the k smallest first tickets can be drawn
+    in the first k draws.
+
+    Adding an id again has no effect, so rescanned ballots need no
+    special handling.  (An id whose ticket has been dropped from the
+    kept k is not remembered, but its ticket is too large to return.)
+
+    Args:
+        seed (object): the seed
+        k (int): the number of draws wanted
+        scheme (str): the hash scheme (see HASH_SCHEMES)
+
+    Attributes:
+        seed, k, scheme: as given
+        added (int): the number of add calls that were for ids not
+            already kept (an upper bound on the distinct ids seen)
+
+    Example:
+        >>> stream = StreamingSample(314159, 3)
+        >>> stream.add_many(['A-1', 'A-2', 'A-3'])
+        >>> stream.sample(output='id')
+        ['A-3', 'A-2', 'A-1']
+        >>> stream.add('B-2'); stream.add('B-3'); stream.add('A-3')
+        >>> stream.sample(output='id')
+        ['B-2', 'B-3', 'A-3']
+        >>> ids = ['A-1', 'A-2', 'A-3', 'B-2', 'B-3']
+        >>> stream.sample() == list(sampler(ids, 314159, take=3))
+        True
+        >>> stream.sample(with_replacement=True) == list(
+        ...     sampler(ids, 314159, with_replacement=True, take=3))
+        True
+    """
+
+    def __init__(self, seed, k, scheme=DEFAULT_SCHEME):
+        assert type(k) is int and k > 0
+        _scheme_hash(scheme)
+        self.seed = seed
+        self.k = k
+        self.scheme = scheme
+        self.added = 0
+        self._seed_hash = hash_hex(seed, scheme)
+        self._heap = []           # _Descending tickets, largest on top
+        self._ids = set()         # the ids of the kept tickets
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __repr__(self):
+        return "<StreamingSample keeping {} of {} tickets>"\
+            .format(len(self._heap), self.k)
+
+    def _offer(self, ticket):
+        if ticket.id in self._ids:
+            return
+        self.added += 1
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, _Descending(ticket))
+        elif ticket < self._heap[0].ticket:
+            dropped = heapq.heapreplace(self._heap, _Descending(ticket))
+            self._ids.discard(dropped.ticket.id)
+        else:
+            return
+        self._ids.add(ticket.id)
+
+    def add(self, id):
+        """Add one id to the collection."""
+
+        self._offer(first_ticket(id, self.seed, self._seed_hash,
+                                 self.scheme))
+
+    def add_many(self, id_list, chunk_size=4096):
+        """Add all of the ids in id_list to the collection, hashing
+        them in bulk."""
+
+        ids = iter(id_list)
+        while True:
+            chunk = list(itertools.islice(ids, chunk_size))
+            if not chunk:
+                return
+            fractions = first_fractions(chunk, self.seed, self._seed_hash,
+                                        self.scheme)
+            for fraction, id in zip(fractions, chunk):
+                self._offer(Ticket(fraction, id, 1))
+
+    def tickets(self):
+        """Return the kept first tickets, in increasing order."""
+
+        return sorted(wrapped.ticket for wrapped in self._heap)
+
+    def sample(self, with_replacement=False, output='tuple', digits=9):
+        """Return the first k draws of the sample of the ids so far.
+
+        Args:
+            with_replacement (bool), output (str), digits (int): as
+                for sampler
+
+        Returns:
+            a list equal to
+                list(sampler(ids, seed, with_replacement, take=k,
+                             output=output, digits=digits, scheme=scheme))
+            for the ids added so far.
+        """
+
+        assert type(with_replacement) is bool
+        output = output.lower()
+        assert output in {'id', 'tuple', 'ticket'}
+        tickets = _heap_tickets(self.tickets(), with_replacement,
+                                self.scheme)
+        return _output_batch(list(itertools.islice(tickets, self.k)),
+                             output, digits)
+
+
+class SampleOrder:
+    """A sample order computed once and held in memory.
+
+    A SampleOrder lists full-precision tickets in sampling order, as
+    sampler would produce them, together with the position in id_list
+    (the "ordinal") of each ticket's id.  As noted in the module
+    docstring, filtering the sample order for a collection down to a
+    subcollection gives the sample order for the subcollection; the
+    subset method does this without recomputing any tickets.
+
+    Args:
+        tickets (list): Tickets in sampling order
+        ordinals (array): for each ticket, the position of its id in
+            the id_list sampled (may be None if not known)
+        scheme (str): the hash scheme the tickets were made with
+
+    Attributes:
+        tickets, ordinals, scheme: as given
+    """
+
+    def __init__(self, tickets, ordinals=None, scheme=DEFAULT_SCHEME):
+        self.tickets = tickets
+        self.ordinals = ordinals
+        self.scheme = scheme
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def __iter__(self):
+        return iter(self.tickets)
+
+    def __getitem__(self, index):
+        return self.tickets[index]
+
+    def __repr__(self):
+        return "<SampleOrder of {} tickets>".format(len(self.tickets))
+
+    def output(self, output='tuple', digits=9, drop=0, take=None):
+        """Return part of the order in the form sampler would yield it.
+
+        Args:
+            output (str), digits (int): as for sampler
+            drop (int): number of tickets to skip
+            take (int): number of tickets to return after the drops
+                (defaults to None, meaning all the rest)
+
+        Returns:
+            a list of ids, tuples or Tickets.
+        """
+
+        output = output.lower()
+        assert output in {'id', 'tuple', 'ticket'}
+        stop = None if take is None else drop + take
+        return _output_batch(self.tickets[drop:stop], output, digits)
+
+    def subset(self, members):
+        """Return the SampleOrder for a subcollection of the ids.
+
+        Args:
+            members: the subcollection, given as one of
+                a set (or other container) of ids;
+                a function of an id returning True for members;
+                a bytes or bytearray bitmap over ordinals, in which
+                    ordinal i is a member if bit (i % 8) of byte
+                    (i // 8) is set (requires known ordinals).
+
+        Returns:
+            a SampleOrder of the tickets whose ids are members, found
+            by one scan of this order, with no hashing.
+
+        Example:
+            >>> order = make_sample_order(['A-1', 'A-2', 'A-3',
+            ...                            'B-1', 'B-2', 'B-3'], seed=314159)
+            >>> b_order = order.subset({'B-1', 'B-2', 'B-3'})
+            >>> b_order.output(output='id')
+            ['B-2', 'B-3', 'B-1']
+            >>> b_order.output() == list(sampler(['B-1', 'B-2', 'B-3'],
+            ...                                  seed=314159))
+            True
+            >>> order.subset(bytes([0b00000101])).output(output='id')
+            ['A-3', 'A-1']
+        """
+
+        if isinstance(members, (bytes, bytearray)):
+            assert self.ordinals is not None,\
+                "SampleOrder.subset by bitmap needs known ordinals"
+            keep = [i for i, ordinal in enumerate(self.ordinals)
+                    if ordinal >> 3 < len(members)
+                    and members[ordinal >> 3] >> (ordinal & 7) & 1]
+        else:
+            if callable(members):
+                member = members
+            else:
+                if not isinstance(members, collections.abc.Container):
+                    members = set(members)
+                member = members.__contains__
+            keep = [i for i, ticket in enumerate(self.tickets)
+                    if member(ticket.id)]
+        tickets = [self.tickets[i] for i in keep]
+        ordinals = None
+        if self.ordinals is not None:
+            ordinals = array.array('q', [self.ordinals[i] for i in keep])
+        return SampleOrder(tickets, ordinals, self.scheme)
+
+
+def make_sample_order(id_list,
+                      seed,
+                      with_replacement=False,
+                      take=float('inf'),
+                      scheme=DEFAULT_SCHEME,
+                      ):
+    """Compute a SampleOrder for id_list.
+
+    Args:
+        id_list, seed, with_replacement, scheme: as for sampler
+        take (int): the number of tickets in the order (must be finite
+            if with_replacement is True)
+
+    Returns:
+        a SampleOrder holding the first take tickets that sampler
+        would produce, at full precision, with their ordinals.
+    """
+
+    assert not with_replacement or take < float('inf'),\
+        "make_sample_order needs a finite take when sampling with replacement"
+    if not isinstance(id_list, collections.abc.Sequence):
+        id_list = list(id_list)
+    _assert_distinct(id_list, 'make_sample_order')
+    assert type(with_replacement) is bool
+    _scheme_hash(scheme)
+    tickets = _ticket_stream(id_list, seed, with_replacement, take,
+                             scheme=scheme)
+    if take < float('inf'):
+        tickets = itertools.islice(tickets, int(take))
+    tickets = list(tickets)
+    drawn = {ticket.id for ticket in tickets}
+    position = {id: i for i, id in enumerate(id_list) if id in drawn}
+    ordinals = array.array('q', [position[ticket.id] for ticket in tickets])
+    return SampleOrder(tickets, ordinals, scheme)
+
+
+class SharedSampleOrder:
+    """A sample order computed once, lazily, for concurrent readers.
+
+    A sampler generator cannot be shared between threads, so each
+    consumer of a sample order would otherwise compute its own.  A
+    SharedSampleOrder draws tickets from a single underlying ticket
+    generator, chunk_size at a time as readers first need them, into a
+    buffer shared by any number of cursors (see cursor), each with its
+    own position.  The lock is taken only to extend the buffer; reading
+    tickets already buffered needs no locking.
+
+    Args:
+        id_list, seed, with_replacement, scheme: as for sampler
+        take (int): the number of tickets in the order (defaults to
+            infinity, so that with replacement the order is unending)
+        chunk_size (int): the number of tickets added to the buffer
+            at a time
+
+    Example:
+        >>> import threading
+        >>> shared = SharedSampleOrder(['A-1', 'A-2', 'A-3',
+        ...                             'B-1', 'B-2', 'B-3'], seed=314159)
+        >>> results = {}
+        >>> def consume(name, count):
+        ...     results[name] = list(itertools.islice(
+        ...         shared.cursor(output='id'), count))
+        >>> threads = [threading.Thread(target=consume, args=(name, count))
+        ...            for name, count in [('ui', 2), ('export', 6)]]
+        >>> for thread in threads:
+        ...     thread.start()
+        >>> for thread in threads:
+        ...     thread.join()
+        >>> results['ui'], results['export']
+        (['B-2', 'B-3'], ['B-2', 'B-3', 'A-3', 'A-2', 'B-1', 'A-1'])
+        >>> progress = shared.cursor(start=4)
+        >>> next(progress), progress.position
+        (('0.9781715679', 'B-1', 1), 5)
+    """
+
+    def __init__(self,
+                 id_list,
+                 seed,
+                 with_replacement=False,
+                 take=float('inf'),
+                 scheme=DEFAULT_SCHEME,
+                 chunk_size=1024,
+                 ):
+        import threading
+        _assert_distinct(id_list, 'SharedSampleOrder')
+        assert type(with_replacement) is bool
+        assert type(chunk_size) is int and chunk_size > 0
+        _scheme_hash(scheme)
+        tickets = _ticket_stream(id_list, seed, with_replacement, take,
+                                 scheme=scheme)
+        if take < float('inf'):
+            tickets = itertools.islice(tickets, int(take))
+        self.scheme = scheme
+        self.chunk_size = chunk_size
+        self._source = tickets
+        self._tickets = []
+        self._exhausted = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<SharedSampleOrder with {} tickets computed>"\
+            .format(len(self._tickets))
+
+    def _extend(self, count):
+        """Buffer at least count tickets (if the order has that many);
+        return True if it has."""
+
+        with self._lock:
+            while len(self._tickets) < count and not self._exhausted:
+                size = max(self.chunk_size, count - len(self._tickets))
+                chunk = list(itertools.islice(self._source, size))
+                if len(chunk) < size:
+                    self._exhausted = True
+                self._tickets.extend(chunk)
+            return len(self._tickets) >= count
+
+    def ticket(self, index):
+        """Return the full-precision Ticket at position index (from 0).
+
+        Raises IndexError if the order has fewer tickets.
+        """
+
+        if index >= len(self._tickets) and not self._extend(index + 1):
+            raise IndexError("sample order has only {} tickets"
+                             .format(len(self._tickets)))
+        return self._tickets[index]
+
+    def tickets(self, start, stop):
+        """Return the list of Tickets at positions start..stop-1 (fewer
+        if the order ends first)."""
+
+        if stop > len(self._tickets):
+            self._extend(stop)
+        return self._tickets[start:stop]
+
+    def cursor(self, output='tuple', digits=9, start=0):
+        """Return a new SampleCursor reading this order from start."""
+
+        return SampleCursor(self, output, digits, start)
+
+
+class SampleCursor:
+    """An independent reading position in a SharedSampleOrder.
+
+    A cursor is an iterator yielding the order's tickets in the form
+    sampler gives for output and digits; take(n) returns the next n
+    at once.  Each cursor should be used by one thread at a time.
+
+    Attributes:
+        order: the SharedSampleOrder read
+        position (int): the position of the next item to be read
+    """
+
+    def __init__(self, order, output='tuple', digits=9, start=0):
+        output = output.lower()
+        assert output in {'id', 'tuple', 'ticket'}
+        assert type(digits) is int
+        self.order = order
+        self.output = output
+        self.digits = digits
+        self.position = start
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            ticket = self.order.ticket(self.position)
+        except IndexError:
+            raise StopIteration from None
+        self.position += 1
+        return _output_form(ticket, self.output, self.digits)
+
+    def take(self, count):
+        """Return a list of the next count items (fewer at the end)."""
+
+        tickets = self.order.tickets(self.position, self.position + count)
+        self.position += len(tickets)
+        return _output_batch(tickets, self.output, self.digits)
+
+
+SHARED_ORDER_MAGIC = b'CSORDER\n'
+"""
+Header identifying a sample order published by publish_sample_order.
+"""
+
+_SHARED_ORDER_HEADER = struct.Struct('<8sBBBxHxxqqQQ')
+# magic, version, flags, scheme length, key width, count, id bytes,
+# and the publisher's resource tracker (see _resource_tracker_id)
+_SHARED_ORDER_VERSION = 2
+_SHARED_ORDER_ORDINALS = 0x01   # flag: ordinals are known
+_SHARED_ORDER_DATA = 64         # offset of the first section
+
+
+def _resource_tracker_id():
+    """Return a pair identifying this process's multiprocessing
+    resource tracker, the same in every process that shares it (such
+    as the children started by multiprocessing), or (0, 0) if shared
+    memory is not tracked on this platform.
+
+    The pair is the device and inode of the pipe to the tracker, which
+    processes sharing the tracker inherit.
+    """
+
+    if os.name != 'posix':
+        return 0, 0
+    from multiprocessing import resource_tracker
+    pipe = os.fstat(resource_tracker.getfd())
+    return pipe.st_dev, pipe.st_ino
+
+
+def _shared_order_layout(count, key_width, id_bytes):
+    """Return the offsets of the sections of a published sample order.
+
+    The sections, after the header and scheme name, are: the ticket
+    keys (count * key_width bytes); the generations and the ordinals
+    (count native 8-byte integers each); the id offsets (count+1
+    native 8-byte integers); and the encoded ids.  Each section
+    starts 8-byte aligned.
+
+    Returns:
+        a tuple (keys, generations, ordinals, offsets, ids, end).
+    """
+
+    def aligned(n):
+        return (n + 7) & ~7
+
+    keys = _SHARED_ORDER_DATA
+    generations = aligned(keys + count * key_width)
+    ordinals = generations + 8 * count
+    offsets = ordinals + 8 * count
+    ids = offsets + 8 * (count + 1)
+    return keys, generations, ordinals, offsets, ids, ids + id_bytes
+
+
+def publish_sample_order(order, name=None):
+    """Copy a SampleOrder into a new block of shared memory.
+
+    The order is stored as fixed-width ticket keys (as in the ticket
+    stream format), arrays of generations and ordinals, and a table of
+    offsets into the encoded ids, so that other processes on the same
+    machine can use it with attach_sample_order without recomputing
+    or copying it.  Ids must be str, int, or literals such as tuples
+    of these (as for TicketStreamWriter).
+
+    The caller owns the returned block: it should stay open while the
+    order is in use, and be closed and unlinked afterwards.
+
+    Args:
+        order (SampleOrder): the sample order to publish
+        name (str): the name for the block; by default a unique
+            name is chosen
+
+    Returns:
+        the multiprocessing.shared_memory.SharedMemory holding the
+        order; its name attribute is what attach_sample_order needs.
+
+    Example:
+        >>> order = make_sample_order(['A-1', 'A-2', 'A-3',
+        ...                            'B-1', 'B-2', 'B-3'], seed=314159)
+        >>> block = publish_sample_order(order)
+        >>> shared = attach_sample_order(block.name)
+        >>> shared.output(output='id', take=3)
+        ['B-2', 'B-3', 'A-3']
+        >>> list(shared) == list(order), shared[1] == order[1]
+        (True, True)
+        >>> shared.subset(bytes([0b00000101])).output(output='id')
+        ['A-3', 'A-1']
+        >>> shared.close()
+        >>> block.close()
+        >>> block.unlink()
+    """
+
+    from multiprocessing import shared_memory
+    tickets = order.tickets
+    count = len(tickets)
+    key_width = max([(len(t.ticket_number) - 1) // 2 for t in tickets],
+                    default=1)
+    encoded = [_encode_id(t.id) for t in tickets]
+    offsets = array.array('q', itertools.accumulate(map(len, encoded),
+                                                    initial=0))
+    scheme = order.scheme.encode('ascii')
+    assert _SHARED_ORDER_HEADER.size + len(scheme) <= _SHARED_ORDER_DATA
+    keys_at, generations_at, ordinals_at, offsets_at, ids_at, end = \
+        _shared_order_layout(count, key_width, offsets[-1])
+
+    flags = 0 if order.ordinals is None else _SHARED_ORDER_ORDINALS
+    block = shared_memory.SharedMemory(name, create=True, size=end)
+    buf = block.buf
+    buf[:_SHARED_ORDER_HEADER.size] = _SHARED_ORDER_HEADER.pack(
+        SHARED_ORDER_MAGIC, _SHARED_ORDER_VERSION, flags, len(scheme),
+        key_width, count, offsets[-1], *_resource_tracker_id())
+    position = _SHARED_ORDER_HEADER.size
+    buf[position:position + len(scheme)] = scheme
+    buf[keys_at:keys_at + count * key_width] = b''.join(
+        _ticket_key(t.ticket_number, key_width) for t in tickets)
+    buf[generations_at:ordinals_at] = \
+        array.array('q', [t.generation for t in tickets]).tobytes()
+    if order.ordinals is not None:
+        buf[ordinals_at:offsets_at] = \
+            array.array('q', order.ordinals).tobytes()
+    buf[offsets_at:ids_at] = offsets.tobytes()
+    buf[ids_at:end] = b''.join(encoded)
+    del buf
+    return block
+
+
+class _SharedTickets(collections.abc.Sequence):
+    """The tickets of a published sample order, decoded on access."""
+
+    def __init__(self, keys, key_width, generations, offsets, ids):
+        self._keys = keys
+        self._key_width = key_width
+        self._generations = generations
+        self._offsets = offsets
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._generations)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ticket index out of range")
+        key_width = self._key_width
+        key = self._keys[index * key_width:(index + 1) * key_width]
+        id_bytes = self._ids[self._offsets[index]:self._offsets[index + 1]]
+        return Ticket(_key_ticket_number(bytes(key)),
+                      _decode_id(bytes(id_bytes)),
+                      self._generations[index])
+
+
+class AttachedSampleOrder(SampleOrder):
+    """A SampleOrder read in place from shared memory.
+
+    Made by attach_sample_order.  It supports everything a SampleOrder
+    does (indexing, slicing, iteration, output and subset), decoding
+    tickets from the shared block only as they are accessed; its
+    ordinals are a read-only memoryview of the shared array.  Call
+    close() when done with it.
+    """
+
+    def __init__(self, block):
+        self._block = block
+        buf = block.buf.toreadonly()
+        (magic, version, flags, scheme_length, key_width, count,
+         id_bytes, *_) = _SHARED_ORDER_HEADER.unpack_from(buf)
+        assert magic == SHARED_ORDER_MAGIC,\
+            "{} does not hold a published sample order".format(block.name)
+        assert version == _SHARED_ORDER_VERSION,\
+            "unsupported published sample order version {}".format(version)
+        position = _SHARED_ORDER_HEADER.size
+        scheme = bytes(buf[position:position + scheme_length]).decode('ascii')
+        keys_at, generations_at, ordinals_at, offsets_at, ids_at, end = \
+            _shared_order_layout(count, key_width, id_bytes)
+        self._views = [buf[keys_at:generations_at],
+                       buf[generations_at:ordinals_at].cast('q'),
+                       buf[ordinals_at:offsets_at].cast('q'),
+                       buf[offsets_at:ids_at].cast('q'),
+                       buf[ids_at:end]]
+        keys, generations, ordinals, offsets, ids = self._views
+        self._views.append(buf)
+        tickets = _SharedTickets(keys, key_width, generations, offsets, ids)
+        if not flags & _SHARED_ORDER_ORDINALS:
+            ordinals = None
+        SampleOrder.__init__(self, tickets, ordinals, scheme)
+
+    def __repr__(self):
+        return "<AttachedSampleOrder of {} tickets in {}>"\
+            .format(len(self.tickets), self._block.name)
+
+    def close(self):
+        """Release the views of the shared block and detach from it."""
+
+        self.tickets = self.ordinals = None
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._block.close()
+
+
+def attach_sample_order(name):
+    """Attach to a sample order published by publish_sample_order.
+
+    Nothing is copied: the returned object reads the shared block in
+    place.  Attaching does not take ownership of the block; it is not
+    unlinked when the attached order is closed or this process exits.
+
+    (Before Python 3.13, attaching to shared memory registers it with
+    the attaching process's resource tracker, which would unlink it
+    when that process exits.  The registration is therefore undone,
+    unless this process shares the publisher's tracker, as processes
+    started from the publisher by multiprocessing do; the tracker then
+    already holds the publisher's registration, which must stay so
+    that the block is removed if the publisher dies.)
+
+    Args:
+        name (str): the name of the shared memory block
+
+    Returns:
+        an AttachedSampleOrder.
+    """
+
+    from multiprocessing import shared_memory
+    if sys.version_info >= (3, 13):
+        return AttachedSampleOrder(
+            shared_memory.SharedMemory(name, track=False))
+    block = shared_memory.SharedMemory(name)
+    if os.name == 'posix':
+        header = _SHARED_ORDER_HEADER.unpack_from(block.buf)
+        shares_tracker = (header[0] == SHARED_ORDER_MAGIC and
+                          header[1] == _SHARED_ORDER_VERSION and
+                          tuple(header[-2:]) == _resource_tracker_id())
+        if not shares_tracker:
+            from multiprocessing import resource_tracker
+            # POSIX shared memory is registered under its name with
+            # the leading slash that SharedMemory.name omits
+            resource_tracker.unregister('/' + block.name, 'shared_memory')
+    return AttachedSampleOrder(block)
+
+
+class BottomKSketch:
+    """A bottom-k sketch: the k smallest first tickets of a collection.
+
+    Since a ticket is a consistent pseudorandom function of its id,
+    the k ids with smallest tickets are a uniform random sample of the
+    distinct ids of a collection, and the same ids are chosen for it
+    wherever it is sketched.  Comparing two sketches (made with the
+    same seed) thus estimates how two large collections, such as a
+    preliminary and a final canvass manifest, overlap without
+    comparing the full lists.  When a collection has fewer than k
+    distinct ids its sketch holds them all and the estimates are
+    exact; otherwise their relative error is about 1/sqrt(k).
+
+    The ids are hashed in a single streaming pass, holding O(k)
+    tickets in memory.  Repeated ids are counted once.  Sketches of
+    separate collections merge into the sketch of their union, so
+    counties can sketch their own manifests and combine the results;
+    the tickets attribute can be shipped (e.g. with TicketStreamWriter)
+    and rebuilt with BottomKSketch.from_tickets.
+
+    Args:
+        seed (object): the seed
+        k (int): the number of tickets kept
+        id_list (iterable): hashable ids to add at once
+        scheme (str): the hash scheme (see HASH_SCHEMES)
+
+    Attributes:
+        seed, k, scheme: as given
+        tickets: a list of the (at most k) smallest first Tickets,
+            in increasing order
+
+    Example:
+        >>> preliminary = BottomKSketch(314159, 256, range(10000))
+        >>> final = BottomKSketch(314159, 256, range(1000, 11500))
+        >>> round(preliminary.jaccard(final), 2)   # actually 0.78
+        0.77
+        >>> round(final.size()), round(preliminary.union_size(final))
+        (10308, 12056)
+        >>> round(final.difference_size(preliminary))   # actually 1500
+        1319
+        >>> small = BottomKSketch(314159, 256, ['a', 'b', 'c', 'a'])
+        >>> small.size(), small.jaccard(BottomKSketch(314159, 256, 'bcd'))
+        (3, 0.5)
+    """
+
+    def __init__(self, seed, k, id_list=(), scheme=DEFAULT_SCHEME):
+        assert type(k) is int and k > 0
+        _scheme_hash(scheme)
+        self.seed = seed
+        self.k = k
+        self.scheme = scheme
+        self.tickets = []
+        self.update(id_list)
+
+    @classmethod
+    def from_tickets(cls, seed, k, tickets, scheme=DEFAULT_SCHEME):
+        """Return the sketch holding the k smallest of the given
+        first-generation tickets (as from another sketch's tickets)."""
+
+        sketch = cls(seed, k, scheme=scheme)
+        sketch.tickets = heapq.nsmallest(k, set(map(Ticket._make, tickets)))
+        return sketch
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def __repr__(self):
+        return "<BottomKSketch of {} of {} tickets>"\
+            .format(len(self.tickets), self.k)
+
+    def add(self, id):
+        """Add one id to the sketched collection."""
+
+        self.update([id])
+
+    def update(self, id_list, chunk_size=4096):
+        """Add all of the ids in id_list to the sketched collection."""
+
+        seed_hash = hash_hex(self.seed, self.scheme)
+        ids = iter(id_list)
+        while True:
+            chunk = list(itertools.islice(ids, chunk_size))
+            if not chunk:
+                return
+            fractions = first_fractions(chunk, self.seed, seed_hash,
+                                        self.scheme)
+            if len(self.tickets) < self.k:
+                candidates = map(Ticket, fractions, chunk,
+                                 itertools.repeat(1))
+            else:
+                threshold = self.tickets[-1].ticket_number
+                candidates = [Ticket(fraction, id, 1)
+                              for fraction, id in zip(fractions, chunk)
+                              if fraction < threshold]
+                if not candidates:
+                    continue
+            self.tickets = heapq.nsmallest(
+                self.k, set(self.tickets).union(candidates))
+
+    def _check_compatible(self, other):
+        assert self.seed == other.seed and self.scheme == other.scheme,\
+            "sketches made with different seeds or schemes cannot be compared"
+
+    def merge(self, other):
+        """Return the sketch of the union of the two collections.
+
+        If the sketches keep different numbers of tickets, the merged
+        sketch keeps the smaller number.
+        """
+
+        self._check_compatible(other)
+        return BottomKSketch.from_tickets(self.seed,
+                                          min(self.k, other.k),
+                                          self.tickets + other.tickets,
+                                          self.scheme)
+
+    __or__ = merge
+
+    def size(self):
+        """Return the estimated number of distinct ids in the collection.
+
+        Uses the unbiased estimate (k-1)/u, where u is the kth smallest
+        ticket number; the count is exact when the sketch is not full.
+        """
+
+        if len(self.tickets) < self.k:
+            return len(self.tickets)
+        return (self.k - 1) / float(self.tickets[-1].ticket_number)
+
+    def _union_fractions(self, other):
+        """Return the union sketch and the fractions of its tickets
+        found in both sketches and in self's sketch only."""
+
+        union = self.merge(other)
+        mine = set(self.tickets)
+        theirs = set(other.tickets)
+        # a ticket in the union sketch is in a sketch exactly when
+        # its id is in that sketch's collection
+        n = len(union.tickets)
+        if n == 0:
+            return union, 1.0, 0.0
+        both = sum(1 for t in union.tickets if t in mine and t in theirs)
+        only_mine = sum(1 for t in union.tickets
+                        if t in mine and t not in theirs)
+        return union, both / n, only_mine / n
+
+    def jaccard(self, other):
+        """Return the estimated Jaccard similarity |A & B| / |A | B| of
+        the two collections (1.0 if both are empty)."""
+
+        return self._union_fractions(other)[1]
+
+    def union_size(self, other):
+        """Return the estimated size of the union of the collections."""
+
+        return self.merge(other).size()
+
+    def intersection_size(self, other):
+        """Return the estimated size of the intersection of the
+        collections."""
+
+        union, both, _ = self._union_fractions(other)
+        return both * union.size()
+
+    def difference_size(self, other):
+        """Return the estimated number of ids in self's collection
+        that are not in other's."""
+
+        union, _, only_mine = self._union_fractions(other)
+        return only_mine * union.size()
+
+
+def _min_first_ticket(chunk_and_seed):
+    """Return the least first-generation Ticket for a chunk of ids.
+
+    Args:
+        chunk_and_seed (tuple): (ids, seed, seed_hash, scheme), packed
+            in one argument so this can be used with
+            multiprocessing.Pool.imap
+
+    Returns:
+        the Ticket with least ticket number, or None if ids is empty.
+    """
+
+    ids, seed, seed_hash, scheme = chunk_and_seed
+    fractions = first_fractions(ids, seed, seed_hash, scheme)
+    if not fractions:
+        return None
+    return min(Ticket(f, id, 1) for f, id in zip(fractions, ids))
+
+
+def verify_sample(published,
+                  id_list,
+                  seed,
+                  with_replacement=False,
+                  processes=None,
+                  chunk_size=10000,
+                  scheme=DEFAULT_SCHEME,
+                  ):
+    """Check that published is a correct initial sample of id_list.
+
+    The published sample is a list of (ticket_number, id, generation)
+    tuples, as produced by sampler (with drop=0) with any positive
+    value of digits.  Rather than rerunning sampler, this recomputes just the
+    listed tickets with first_ticket and next_ticket, and then makes
+    one streaming pass over id_list, hashing the unlisted ids without
+    building a heap, to confirm that no ticket was left out.
+
+    Args:
+        published (list): the published (ticket_number, id, generation)
+            tuples, in the order published
+        id_list (iterable): the collection of ids that was sampled
+        seed (object): the seed used for sampling
+        with_replacement (bool): True if the sample was drawn with
+            replacement
+        processes (int): if given, the streaming pass is divided among
+            this many worker processes
+        chunk_size (int): number of ids hashed per batch in the
+            streaming pass
+        scheme (str): the hash scheme the sample was drawn with
+
+    Returns:
+        None if the published sample is correct, and otherwise a
+        string describing the first (earliest in published)
+        discrepancy found.
+
+    Examples:
+        >>> ids = ['ab-1', 'ab-2', 'cd-1', 'ef-3']
+        >>> published = list(sampler(ids, seed=314159, take=2))
+        >>> print(verify_sample(published, ids, seed=314159))
+        None
+        >>> print(verify_sample(published[1:], ids, seed=314159))
+        position 0: ticket for 'cd-1' (0.317685817...) is missing
+        >>> published[1] = ('0.832984519', 'ab-1', 1)
+        >>> print(verify_sample(published, ids, seed=314159))
+        position 1: ticket number 0.832984519 does not match 0.9098039269... for 'ab-1' generation 1
+        >>> published = list(sampler(ids, seed=314159, take=2))
+        >>> published[0] = ('0.', 'cd-1', 1)
+        >>> print(verify_sample(published, ids, seed=314159))
+        position 0: ticket number 0. does not match 0.317685817... for 'cd-1' generation 1
+        >>> published[0] = ('', 'cd-1', 1)
+        >>> verify_sample(published, ids, seed=314159) is None
+        False
+    """
+
+    assert type(with_replacement) is bool
+    seed_hash = hash_hex(seed, scheme)
+    discrepancies = []
+
+    # Recompute the published tickets themselves.
+    full_numbers = []
+    last_ticket = {}            # id -> latest recomputed Ticket
+    first_position = {}         # id -> position of its first appearance
+    first_numbers = {}          # as for _next_chain_ticket
+    for position, (ticket_number, id, generation) in enumerate(published):
+        previous = last_ticket.get(id)
+        if previous is not None and not with_replacement:
+            discrepancies.append(
+                (position, "{!r} appears more than once".format(id)))
+            break
+        expected_generation = 1 if previous is None \
+            else previous.generation + 1
+        if generation != expected_generation:
+            discrepancies.append(
+                (position, "{!r} has generation {}, expected {}"
+                 .format(id, generation, expected_generation)))
+            break
+        if previous is None:
+            ticket = first_ticket(id, seed, seed_hash, scheme)
+            first_position[id] = position
+        else:
+            ticket = _next_chain_ticket(previous, scheme, first_numbers)
+        last_ticket[id] = ticket
+        # ticket_number must be trim(ticket.ticket_number, d) for some
+        # d >= 1, so must go at least one digit past any leading 9s
+        if (len(ticket_number) < len(trim(ticket.ticket_number, 1))
+                or not ticket.ticket_number.startswith(ticket_number)):
+            discrepancies.append(
+                (position, "ticket number {} does not match {}... for {!r} "
+                 "generation {}".format(ticket_number,
+                                        trim(ticket.ticket_number),
+                                        id, generation)))
+            break
+        if full_numbers and ticket.ticket_number <= full_numbers[-1]:
+            discrepancies.append(
+                (position, "ticket for {!r} is out of order".format(id)))
+            break
+        full_numbers.append(ticket.ticket_number)
+
+    # Stream over id_list, checking that the published ids are present
+    # and finding the least ticket that was not published.
+    def chunks():
+        chunk = []
+        for id in id_list:
+            if id in first_position:
+                found.add(id)
+            else:
+                chunk.append(id)
+                if len(chunk) >= chunk_size:
+                    yield (chunk, seed, seed_hash, scheme)
+                    chunk = []
+        if chunk:
+            yield (chunk, seed, seed_hash, scheme)
+
+    found = set()
+    if processes is None:
+        minima = list(map(_min_first_ticket, chunks()))
+    else:
+        import multiprocessing
+        with multiprocessing.Pool(processes) as pool:
+            minima = list(pool.imap(_min_first_ticket, chunks()))
+    candidates = [t for t in minima if t is not None]
+    if with_replacement:
+        candidates.extend(_next_chain_ticket(t, scheme, first_numbers)
+                          for t in last_ticket.values())
+
+    for id, position in first_position.items():
+        if id not in found:
+            discrepancies.append(
+                (position, "{!r} is not in id_list".format(id)))
+    if candidates and full_numbers:
+        missing = min(candidates)
+        if missing.ticket_number < full_numbers[-1]:
+            position = next(i for i, number in enumerate(full_numbers)
+                            if number > missing.ticket_number)
+            discrepancies.append(
+                (position, "ticket for {!r} ({}...) is missing"
+                 .format(missing.id, trim(missing.ticket_number))))
+
+    if not discrepancies:
+        return None
+    position, message = min(discrepancies, key=lambda d: d[0])
+    return "position {}: {}".format(position, message)
+
+
+NPZ_COLUMNS = ('ticket_number', 'id', 'generation')
+"""
+Names of the arrays in a .npz file written by export_sample_npz.
+"""
+
+
+def _npy_header(descr, count):
+    """Return NPY (format version 1.0) header for a 1-d array.
+
+    Args:
+        descr (str): NumPy dtype descriptor, such as '<i8' or '<U11'
+        count (int): number of elements in the array
+
+    Returns:
+        the header as bytes, padded so the data starts 64-byte aligned.
+    """
+
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}"\
+        .format(descr, count)
+    pad = 63 - (10 + len(header)) % 64
+    header = header + " " * pad + "\n"
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) \
+        + header.encode('latin1')
+
+
+def _spill_strings(values, data_file, lengths):
+    """Append strings to a column spill file as unpadded UTF-32.
+
+    Args:
+        values (list): list of str for one chunk of a string column
+        data_file (file): binary file receiving the UTF-32-LE text
+        lengths (array): array('L') receiving the length of each string
+    """
+
+    lengths.extend(map(len, values))
+    data_file.write("".join(values).encode('utf-32-le'))
+
+
+def _write_string_column(zf, name, data_file, lengths, chunk_size):
+    """Write a spilled string column into zip file zf as a '<U' array.
+
+    NumPy fixed-width unicode arrays need the maximum width up front,
+    which is only known once every chunk has been seen; the column is
+    therefore spilled unpadded and padded here, one chunk at a time.
+    """
+
+    width = max(lengths, default=0) or 1
+    data_file.seek(0)
+    with zf.open(name + '.npy', 'w', force_zip64=True) as out:
+        out.write(_npy_header('<U{}'.format(width), len(lengths)))
+        for start in range(0, len(lengths), chunk_size):
+            chunk_lengths = lengths[start:start+chunk_size]
+            text = data_file.read(4 * sum(chunk_lengths)).decode('utf-32-le')
+            padded = []
+            pos = 0
+            for n in chunk_lengths:
+                padded.append(text[pos:pos+n].ljust(width, '\0'))
+                pos += n
+            out.write("".join(padded).encode('utf-32-le'))
+
+
+def export_sample_npz(path,
+                      id_list,
+                      seed,
+                      with_replacement=False,
+                      drop=0,
+                      take=float('inf'),
+                      digits=9,
+                      chunk_size=65536,
+                      scheme=DEFAULT_SCHEME,
+                      ):
+    """Write a sample order to a NumPy .npz file, column by column.
+
+    The file holds three equal-length arrays named by NPZ_COLUMNS:
+        ticket_number: fixed-width unicode ('<U'), trimmed to digits
+        id: fixed-width unicode ('<U') holding the id if it is a str,
+            and otherwise the text of the int or literal (such as a
+            tuple of strings) it is
+        generation: 64-bit integers
+    so that, for example,
+        pandas.DataFrame(dict(numpy.load(path)))
+    gives the sample order as a table.  An array named 'id_type'
+    records for each id whether it is a str, an int or a literal
+    (as b's', b'i' or b'r'), so that load_sample_npz gives back the
+    very same ids; other ids raise ValueError.  The hash scheme is
+    recorded in a one-element array named 'scheme'.  NumPy is not
+    needed to write the file; draws are taken from the ticket engine
+    and formatted a chunk of chunk_size at a time.
+
+    Args:
+        path (str): name of the .npz file to write
+        id_list, seed, with_replacement, drop, take, digits, scheme:
+            as for sampler.  If with_replacement is True, take must
+            be finite.
+        chunk_size (int): number of draws encoded per chunk
+
+    Returns:
+        the number of rows written.
+
+    Example:
+        >>> import os, tempfile
+        >>> directory = tempfile.TemporaryDirectory()
+        >>> path = os.path.join(directory.name, 'order.npz')
+        >>> export_sample_npz(path, ['ab-1', 'ab-2', 'cd-1', 'ef-3'],
+        ...                   seed=314159, take=3)
+        3
+        >>> for t in load_sample_npz(path):
+        ...     print(t)
+        ('0.317685817', 'cd-1', 1)
+        ('0.832984519', 'ef-3', 1)
+        ('0.9098039269', 'ab-1', 1)
+        >>> load_sample_npz(path, with_scheme=True)[1]
+        'sha256-v1'
+        >>> export_sample_npz(path, [17, ('B', 2), 'C-3'], seed=314159)
+        3
+        >>> load_sample_npz(path)
+        [('0.292472157', ('B', 2), 1), ('0.554613624', 'C-3', 1), ('0.9479399562', 17, 1)]
+        >>> directory.cleanup()
+    """
+
+    assert not with_replacement or take < float('inf'),\
+        "export_sample_npz needs a finite take when sampling with replacement"
+    assert type(chunk_size) is int and chunk_size > 0
+    _assert_distinct(id_list, 'export_sample_npz')
+    assert type(digits) is int
+    _scheme_hash(scheme)
+
+    gen_code = 'q'
+    gen_descr = ('<' if sys.byteorder == 'little' else '>') + 'i8'
+    tickets = _ticket_stream(id_list, seed, with_replacement, drop + take,
+                             scheme=scheme)
+    tickets = itertools.islice(tickets, drop,
+                               None if take == float('inf')
+                               else drop + int(take))
+    count = 0
+    with tempfile.TemporaryFile() as number_file, \
+            tempfile.TemporaryFile() as id_file, \
+            tempfile.TemporaryFile() as type_file, \
+            tempfile.TemporaryFile() as generation_file:
+        number_lengths = array.array('L')
+        id_lengths = array.array('L')
+        while True:
+            chunk = list(itertools.islice(tickets, chunk_size))
+            if not chunk:
+                break
+            ids = [ticket.id for ticket in chunk]
+            if all(type(id) is str for id in ids):
+                types = b's' * len(ids)
+            else:
+                encoded = [_encode_id(id) for id in ids]
+                types = b''.join(data[:1] for data in encoded)
+                ids = [data[1:].decode('utf-8') for data in encoded]
+            _spill_strings(_trimmed_numbers(chunk, digits), number_file,
+                           number_lengths)
+            _spill_strings(ids, id_file, id_lengths)
+            type_file.write(types)
+            generation_file.write(array.array(
+                gen_code, [ticket.generation for ticket in chunk]).tobytes())
+            count += len(chunk)
+
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as zf:
+            _write_string_column(zf, 'ticket_number',
+                                 number_file, number_lengths, chunk_size)
+            _write_string_column(zf, 'id',
+                                 id_file, id_lengths, chunk_size)
+            generation_file.seek(0)
+            with zf.open('generation.npy', 'w', force_zip64=True) as out:
+                out.write(_npy_header(gen_descr, count))
+                for block in iter(lambda: generation_file.read(1 << 20), b''):
+                    out.write(block)
+            type_file.seek(0)
+            with zf.open('id_type.npy', 'w', force_zip64=True) as out:
+                out.write(_npy_header('|S1', count))
+                for block in iter(lambda: type_file.read(1 << 20), b''):
+                    out.write(block)
+            scheme_descr = '<U{}'.format(len(scheme))
+            zf.writestr('scheme.npy', _npy_header(scheme_descr, 1)
+                        + scheme.encode('utf-32-le'))
+    return count
+
+
+def _read_npy(f):
+    """Return (descr, count, data bytes) for the 1-d NPY file f."""
+
+    assert f.read(6) == b'\x93NUMPY', "not an NPY file"
+    major, _ = f.read(2)
+    size_format = '<H' if major == 1 else '<I'
+    header_len, = struct.unpack(size_format,
+                                f.read(struct.calcsize(size_format)))
+    header = ast.literal_eval(f.read(header_len).decode('latin1'))
+    assert not header['fortran_order'] and len(header['shape']) == 1
+    return header['descr'], header['shape'][0], f.read()
+
+
+def load_sample_npz(path, with_scheme=False):
+    """Read back a sample order written by export_sample_npz.
+
+    Does not require NumPy.
+
+    Args:
+        path (str): name of the .npz file
+        with_scheme (bool): if True, also return the hash scheme
+
+    Returns:
+        a list of (ticket_number, id, generation) tuples, where
+        ticket_number is a string and id is the id as written; if
+        with_scheme is True, a pair of that list and the name of the
+        hash scheme.
+    """
+
+    columns = {}
+    with zipfile.ZipFile(path) as zf:
+        for name in NPZ_COLUMNS:
+            with zf.open(name + '.npy') as f:
+                descr, count, data = _read_npy(f)
+            if descr[1] == 'U':
+                width = int(descr[2:])
+                text = data.decode('utf-32-le' if descr[0] in '<|'
+                                   else 'utf-32-be')
+                columns[name] = [text[i:i+width].rstrip('\0')
+                                 for i in range(0, width*count, width)]
+            else:
+                values = array.array('q', data)
+                if descr[0] != ('<' if sys.byteorder == 'little' else '>'):
+                    values.byteswap()
+                columns[name] = list(values)
+        with zf.open('scheme.npy') as f:
+            descr, _, data = _read_npy(f)
+        scheme = data.decode('utf-32-le' if descr[0] in '<|'
+                             else 'utf-32-be').rstrip('\0')
+        with zf.open('id_type.npy') as f:
+            _, _, types = _read_npy(f)
+        if types.strip(b's'):
+            columns['id'] = [
+                id if tag == 0x73 else
+                _decode_id(bytes([tag]) + id.encode('utf-8'))
+                for tag, id in zip(types, columns['id'])]
+    rows = list(zip(*(columns[name] for name in NPZ_COLUMNS)))
+    if with_scheme:
+        return rows, scheme
+    return rows
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -0,0 +1,368 @@
+"""Local sampling daemon for consistent_sampler.py
+
+Short-lived scripts that call sampler() pay the whole cost of hashing
+and ordering the ids every time they run.  This module provides a
+small long-running service, listening on a localhost HTTP port, that
+keeps recently used sample orders in memory and serves pages of them,
+such as "items 500 to 1000 of the sample order for this manifest and
+seed".  Requests and replies are JSON:
+
+    POST /manifests   {"ids": [...]}
+                      or {"batches": [[batch_id, count], ...],
+                          "id_format": "{batch}-{number}"}
+        registers a manifest (as a list of ids or as a BatchManifest)
+        and replies {"fingerprint": ..., "size": ...}
+    POST /sample      {"fingerprint": ..., "seed": ..., "start": 0,
+                       "stop": 10, "with_replacement": false,
+                       "output": "tuple", "digits": 9,
+                       "scheme": "sha256-v1"}
+        replies {"items": [...], "cached": true or false}, where items
+        are the outputs start..stop-1 (counting from 0) of
+            sampler(ids, seed, with_replacement, output=output,
+                    digits=digits, scheme=scheme)
+        stop may be omitted, except when sampling with replacement.
+    GET /metrics
+        replies with request counts, cache hit rate and latencies.
+
+JSON lists in ids are taken as tuples, so that ids such as
+("B-17", 3) can be given; note that the ticket of an id depends on its
+string form, so ids must be given with the same types as elsewhere.
+
+Sample orders are cached, least recently used first out, keyed by the
+manifest fingerprint, the seed and the sampling options.  A cached
+order is extended (by recomputing it, at least doubling its length)
+when a later request reaches past its end.
+
+Run as
+    python sampler_daemon.py --port 8765
+or start a daemon in the current process with start_daemon, as in:
+
+    >>> server = start_daemon(port=0)
+    >>> client = SamplerClient(server.url)
+    >>> fingerprint = client.add_manifest(
+    ...     ids=['A-1', 'A-2', 'A-3', 'B-1', 'B-2', 'B-3'])
+    >>> client.sample(fingerprint, 314159, stop=3, output='id')
+    ['B-2', 'B-3', 'A-3']
+    >>> client.sample(fingerprint, 314159, start=1, stop=3)
+    [['0.470960291', 'B-3', 1], ['0.471438751', 'A-3', 1]]
+    >>> client.sample(fingerprint, 314159, start=3, stop=5, output='id')
+    ['A-2', 'B-1']
+    >>> metrics = client.metrics()
+    >>> metrics['sample_requests'], metrics['cache_hits']
+    (3, 1)
+    >>> server.shutdown()
+    >>> server.server_close()
+"""
+
+import argparse
+import collections
+import http.server
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from consistent_sampler import *
+
+
+def _json_id(value):
+    """Return the id for a JSON value, with lists taken as tuples."""
+
+    if isinstance(value, list):
+        return tuple(_json_id(item) for item in value)
+    return value
+
+
+class _LRUCache:
+    """A mapping holding at most maxsize items, dropping the least
+    recently used item when full."""
+
+    def __init__(self, maxsize):
+        assert type(maxsize) is int and maxsize > 0
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Return the value for key (or None), marking it recently used."""
+
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+
+class SamplerService:
+    """The manifests, cached sample orders and metrics of a daemon.
+
+    The methods may be called from several threads at once.
+
+    Args:
+        cache_size (int): the number of sample orders kept
+        manifest_cache_size (int): the number of manifests kept
+    """
+
+    def __init__(self, cache_size=16, manifest_cache_size=64):
+        self._manifests = _LRUCache(manifest_cache_size)
+        self._orders = _LRUCache(cache_size)
+        self._lock = threading.Lock()
+        self._sample_requests = 0
+        self._cache_hits = 0
+        self._total_seconds = 0.0
+        self._max_seconds = 0.0
+
+    def add_manifest(self, ids=None, batches=None,
+                     id_format='{batch}-{number}'):
+        """Register a manifest, given as ids or as batches.
+
+        Returns:
+            a pair (fingerprint, size), where fingerprint is the hex
+            SHA256 hash of the manifest's JSON description.
+        """
+
+        assert (ids is None) != (batches is None),\
+            "give a manifest as either ids or batches"
+        if ids is not None:
+            description = ['ids', ids]
+            id_list = [_json_id(id) for id in ids]
+            assert len(id_list) == len(set(id_list)),\
+                "manifest contains duplicate ids"
+        else:
+            description = ['batches', batches, id_format]
+            id_list = BatchManifest([(_json_id(batch_id), count)
+                                     for batch_id, count in batches],
+                                    id_format)
+        fingerprint = sha256_hex(json.dumps(description, sort_keys=True,
+                                            separators=(',', ':')))
+        with self._lock:
+            self._manifests.put(fingerprint, id_list)
+        return fingerprint, len(id_list)
+
+    def sample(self,
+               fingerprint,
+               seed,
+               start=0,
+               stop=None,
+               with_replacement=False,
+               output='tuple',
+               digits=9,
+               scheme=DEFAULT_SCHEME,
+               ):
+        """Return items start..stop-1 of a sample order, and whether
+        the order was already cached far enough.
+
+        Raises KeyError if the manifest is not (or no longer)
+        registered.
+        """
+
+        began = time.perf_counter()
+        assert type(start) is int and start >= 0
+        assert stop is None or (type(stop) is int and stop >= start)
+        assert stop is not None or not with_replacement,\
+            "stop is needed when sampling with replacement"
+        key = (fingerprint, json.dumps(seed), with_replacement, scheme)
+        with self._lock:
+            id_list = self._manifests.get(fingerprint)
+            order = self._orders.get(key)
+        if id_list is None:
+            raise KeyError("unknown manifest {}".format(fingerprint))
+        wanted = float('inf') if stop is None else stop
+        complete = order is not None and (len(order) >= wanted or
+                                          (not with_replacement and
+                                           len(order) == len(id_list)))
+        if not complete:
+            take = max(wanted, 2 * len(order) if order else 0)
+            if not with_replacement:
+                take = min(take, len(id_list))
+            order = make_sample_order(id_list, seed, with_replacement,
+                                      take=take, scheme=scheme)
+            with self._lock:
+                self._orders.put(key, order)
+        items = order.output(output=output, digits=digits, drop=start,
+                             take=None if stop is None else stop - start)
+        seconds = time.perf_counter() - began
+        with self._lock:
+            self._sample_requests += 1
+            self._cache_hits += complete
+            self._total_seconds += seconds
+            self._max_seconds = max(self._max_seconds, seconds)
+        return items, complete
+
+    def metrics(self):
+        """Return a dict of request counts, hit rate and latencies."""
+
+        with self._lock:
+            requests = self._sample_requests
+            return {
+                'sample_requests': requests,
+                'cache_hits': self._cache_hits,
+                'hit_rate': self._cache_hits / requests if requests else None,
+                'mean_latency_ms':
+                    1000 * self._total_seconds / requests if requests
+                    else None,
+                'max_latency_ms': 1000 * self._max_seconds,
+                'cached_orders': len(self._orders),
+                'manifests': len(self._manifests),
+            }
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Answers the JSON requests of a daemon (see the module docstring)."""
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._reply(200, self.server.service.metrics())
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        service = self.server.service
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if self.path == '/manifests':
+                fingerprint, size = service.add_manifest(**request)
+                self._reply(200, {'fingerprint': fingerprint,
+                                  'size': size})
+            elif self.path == '/sample':
+                items, cached = service.sample(**request)
+                self._reply(200, {'items': items, 'cached': cached})
+            else:
+                self._reply(404, {'error': 'not found'})
+        except KeyError as error:
+            self._reply(404, {'error': str(error.args[0])})
+        except (AssertionError, TypeError, ValueError) as error:
+            self._reply(400, {'error': str(error) or type(error).__name__})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_daemon(host='127.0.0.1', port=0, cache_size=16):
+    """Start a daemon serving in a background thread of this process.
+
+    Args:
+        host (str): the address to listen on (by default, only local
+            connections are accepted)
+        port (int): the port; 0 picks a free port
+        cache_size (int): the number of sample orders kept
+
+    Returns:
+        the running http.server.ThreadingHTTPServer, whose url
+        attribute gives its address, and whose service attribute is
+        its SamplerService.  Call its shutdown and server_close
+        methods to stop it.
+    """
+
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.service = SamplerService(cache_size)
+    server.url = 'http://{}:{}'.format(*server.server_address[:2])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class SamplerClient:
+    """A client for a sampling daemon at the given url.
+
+    Errors reported by the daemon are raised as ValueError (or
+    KeyError, for an unknown manifest).
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def _request(self, path, body=None):
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        request = urllib.request.Request(
+            self.url + path, data=data,
+            headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as error:
+            message = json.loads(error.read()).get('error')
+            if error.code == 404:
+                raise KeyError(message) from None
+            raise ValueError(message) from None
+
+    def add_manifest(self, ids=None, batches=None,
+                     id_format='{batch}-{number}'):
+        """Register a manifest with the daemon; return its fingerprint.
+
+        Args:
+            ids (list): the ids, or
+            batches (list): (batch_id, count) pairs, with id_format,
+                as for BatchManifest
+        """
+
+        body = {'ids': ids} if batches is None else \
+            {'batches': batches, 'id_format': id_format}
+        return self._request('/manifests', body)['fingerprint']
+
+    def sample(self,
+               fingerprint,
+               seed,
+               start=0,
+               stop=None,
+               with_replacement=False,
+               output='tuple',
+               digits=9,
+               scheme=DEFAULT_SCHEME,
+               ):
+        """Return items start..stop-1 of the sample order of a
+        registered manifest (as lists, where sampler gives tuples)."""
+
+        return self._request('/sample', {
+            'fingerprint': fingerprint, 'seed': seed,
+            'start': start, 'stop': stop,
+            'with_replacement': with_replacement, 'output': output,
+            'digits': digits, 'scheme': scheme})['items']
+
+    def metrics(self):
+        """Return the daemon's metrics (see SamplerService.metrics)."""
+
+        return self._request('/metrics')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve consistent_sampler sample orders over "
+                    "localhost HTTP.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache-size', type=int, default=16)
+    args = parser.parse_args()
+    server = http.server.ThreadingHTTPServer((args.host, args.port),
+                                             _Handler)
+    server.daemon_threads = True
+    server.service = SamplerService(args.cache_size)
+    print("consistent_sampler daemon on http://{}:{}"
+          .format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
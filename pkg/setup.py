@@ -14,6 +14,13 @@ setuptools.setup(
     url="https://github.com/ron-rivest/consistent_sampler",
     # packages=setuptools.find_packages(),
     packages=['consistent_sampler'],
+    # Optional compiled ticket kernel; if it cannot be built, the
+    # package falls back to its pure-Python implementation.
+    ext_modules=[
+        setuptools.Extension('consistent_sampler._ticket_kernel',
+                             sources=['consistent_sampler/_ticket_kernel.c'],
+                             optional=True),
+    ],
     license='MIT License',
     classifiers=(
         "Programming Language :: Python :: 3",